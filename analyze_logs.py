@@ -1,42 +1,355 @@
+"""
+Анализ логов бота: потоковое чтение JSON-массива или JSON lines любого размера.
+
+Считает долю ошибок по типам, перцентили латентности по моделям и этапам (span'ы трасс),
+самых активных пользователей и всплески rate limit / FloodWait по окнам времени.
+
+    python analyze_logs.py logs/bot.log logs/worker-*.log
+    python analyze_logs.py railway_export.json --format json --window 10 > before.json
+"""
+import argparse
+import gzip
+import io
 import json
+import math
+import re
 import sys
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, TextIO
+
+CHUNK_SIZE = 64 * 1024
+
+# Текстовый формат логов: "2024-01-01 12:00:00,123 - name - LEVEL - message"
+_TEXT_LINE = re.compile(r"^(\d{4}-\d\d-\d\d[ T][\d:.,]+)\s+-\s+(\S+)\s+-\s+(\w+)\s+-\s+(.*)$")
+_EXCEPTION_NAME = re.compile(r"\b([A-Z]\w*(?:Error|Exception|RetryAfter|Timeout))\b")
+_RATE_LIMIT = re.compile(r"rate limit exceeded", re.I)
+_FLOOD_WAIT = re.compile(r"flood|retry ?after|too many requests", re.I)
+
+
+# --- Чтение ---
+
+def open_log(path: str) -> TextIO:
+    if path == "-":
+        return sys.stdin
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+def iter_json_array(stream: TextIO, buffer: str = "") -> Iterator[Any]:
+    """Элементы JSON-массива по одному: в памяти только текущий элемент и кусок файла"""
+    decoder = json.JSONDecoder()
+    pos = buffer.index("[") + 1
+    eof = False
+    while True:
+        # Пропускаем пробелы и запятые между элементами
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            buffer, pos = buffer[pos:] + stream.read(CHUNK_SIZE), 0
+            eof = len(buffer) == 0
+        if pos >= len(buffer) or buffer[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = stream.read(CHUNK_SIZE)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield item
+        pos = end
+
+
+def iter_records(stream: TextIO) -> Iterator[Dict[str, Any]]:
+    """Записи лога из JSON-массива (экспорт Railway) или построчного файла (JSON lines / текст)"""
+    head = stream.read(CHUNK_SIZE)
+    if head.lstrip().startswith("["):
+        for item in iter_json_array(stream, head):
+            yield normalize(item)
+        return
+    lines = io.StringIO(head + stream.readline())
+    for line in lines:
+        yield from _parse_line(line)
+    for line in stream:
+        yield from _parse_line(line)
+
+
+def _parse_line(line: str) -> Iterator[Dict[str, Any]]:
+    line = line.strip()
+    if not line:
+        return
+    if line.startswith("{"):
+        try:
+            yield normalize(json.loads(line))
+            return
+        except json.JSONDecodeError:
+            pass
+    yield normalize(line)
 
-file_path = "/Users/guest1/Downloads/Sary Bala Bot Logs.json"
 
-try:
-    with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
-        
+def normalize(item: Any) -> Dict[str, Any]:
+    """Приводит запись к полям ts/level/logger/msg независимо от источника"""
+    if not isinstance(item, dict):
+        item = {"msg": str(item)}
+    record = dict(item)
+    msg = str(record.pop("msg", record.pop("message", "")))
+
+    # Railway кладет нашу JSON-строку целиком в message
+    if msg.startswith("{"):
+        try:
+            inner = json.loads(msg)
+            if isinstance(inner, dict):
+                for key, value in inner.items():
+                    record.setdefault(key, value)
+                msg = str(inner.get("msg", msg))
+        except json.JSONDecodeError:
+            pass
+
+    match = _TEXT_LINE.match(msg)
+    if match:
+        record.setdefault("ts", match.group(1))
+        record.setdefault("logger", match.group(2))
+        record.setdefault("level", match.group(3))
+        msg = match.group(4)
+
+    record["msg"] = msg
+    level = str(record.get("level") or record.get("severity") or "INFO").upper()
+    record["level"] = "WARNING" if level == "WARN" else level
+    record["ts"] = parse_ts(record.get("ts") or record.get("timestamp"))
+    return record
+
+
+def parse_ts(value: Any) -> Optional[float]:
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().replace(",", ".").replace("Z", "+00:00")
     try:
-        data = json.loads(content)
-        # Assuming it's a list of log entries
-        if isinstance(data, list):
-            print(f"Loaded {len(data)} log entries.")
-            errors = []
-            for entry in data:
-                # Adjust fields based on structure, usually 'message', 'level', etc.
-                # If entry is a dict
-                if isinstance(entry, dict):
-                    msg = str(entry).lower()
-                    if "error" in msg or "exception" in msg or "critical" in msg or "failed" in msg:
-                        errors.append(entry)
-                # If entry is string
-                elif isinstance(entry, str):
-                    if "error" in entry.lower():
-                        errors.append(entry)
-            
-            print(f"Found {len(errors)} errors.")
-            print("Last 5 errors:")
-            for e in errors[-5:]:
-                print(json.dumps(e, indent=2, ensure_ascii=False))
-        else:
-            print("JSON is not a list. Structure:", type(data))
-            # recursive search or just print part of it?
-            print(str(data)[:1000])
-
-    except json.JSONDecodeError:
-        print("File is not valid JSON. Showing last 2000 chars:")
-        print(content[-2000:])
-
-except Exception as e:
-    print(f"Error reading file: {e}")
+        dt = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+# --- Агрегаты ---
+
+class LatencyDigest:
+    """Логарифмическая гистограмма: фиксированная память, перцентили с точностью ~5%"""
+
+    GROWTH = 1.1
+    MIN_MS = 0.1
+
+    def __init__(self):
+        self.buckets: Counter = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value_ms: float):
+        value_ms = max(float(value_ms), self.MIN_MS)
+        self.buckets[int(math.log(value_ms / self.MIN_MS, self.GROWTH))] += 1
+        self.count += 1
+        self.total += value_ms
+        self.max = max(self.max, value_ms)
+
+    def percentile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # Середина корзины, но не больше реального максимума
+                return min(self.MIN_MS * self.GROWTH ** (index + 0.5), self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 1) if self.count else 0.0,
+            "p50": round(self.percentile(0.5), 1),
+            "p90": round(self.percentile(0.9), 1),
+            "p99": round(self.percentile(0.99), 1),
+            "max": round(self.max, 1),
+        }
+
+
+class LogStats:
+    def __init__(self, window: int = 300, top: int = 10):
+        self.window = window
+        self.top = top
+        self.total = 0
+        self.levels: Counter = Counter()
+        self.error_types: Counter = Counter()
+        self.model_latency: Dict[str, LatencyDigest] = defaultdict(LatencyDigest)
+        # Время до ошибки генерации отдельно: быстрые отказы (429, таймауты) искажали бы перцентили ответов
+        self.model_error_latency: Dict[str, LatencyDigest] = defaultdict(LatencyDigest)
+        self.stage_latency: Dict[str, LatencyDigest] = defaultdict(LatencyDigest)
+        self.user_updates: Counter = Counter()
+        self.user_records: Counter = Counter()
+        self.incidents: Dict[int, Counter] = defaultdict(Counter)
+        self.first_ts: Optional[float] = None
+        self.last_ts: Optional[float] = None
+
+    def add(self, record: Dict[str, Any]):
+        self.total += 1
+        level = record["level"]
+        msg = record["msg"]
+        ts = record["ts"]
+        self.levels[level] += 1
+        if ts is not None:
+            self.first_ts = ts if self.first_ts is None else min(self.first_ts, ts)
+            self.last_ts = ts if self.last_ts is None else max(self.last_ts, ts)
+
+        if level in ("ERROR", "CRITICAL"):
+            self.error_types[error_type(record)] += 1
+
+        user_id = record.get("user_id")
+        if user_id is not None:
+            self.user_records[str(user_id)] += 1
+
+        spans = record.get("spans")
+        if isinstance(spans, list):
+            # Запись трассы: одна на апдейт
+            if user_id is not None:
+                self.user_updates[str(user_id)] += 1
+            if record.get("latency_ms") is not None:
+                self.stage_latency["update"].add(record["latency_ms"])
+            for span in spans:
+                if isinstance(span, dict) and span.get("duration_ms") is not None:
+                    self.stage_latency[str(span.get("name"))].add(span["duration_ms"])
+        elif record.get("model") and record.get("latency_ms") is not None:
+            latency = self.model_error_latency if level in ("ERROR", "CRITICAL") else self.model_latency
+            latency[str(record["model"])].add(record["latency_ms"])
+
+        incident = None
+        if _RATE_LIMIT.search(msg):
+            incident = "rate_limit"
+        elif (level != "INFO" and _FLOOD_WAIT.search(msg)) or record.get("error_type") == "TelegramRetryAfter":
+            incident = "flood_wait"
+        if incident and ts is not None:
+            self.incidents[int(ts // self.window) * self.window][incident] += 1
+
+    def report(self) -> Dict[str, Any]:
+        errors = sum(self.error_types.values())
+        users = self.user_updates if self.user_updates else self.user_records
+        return {
+            "records": self.total,
+            "period": {"from": _iso(self.first_ts), "to": _iso(self.last_ts)},
+            "levels": dict(self.levels),
+            "errors": {
+                "total": errors,
+                "rate": round(errors / self.total, 4) if self.total else 0.0,
+                "by_type": dict(self.error_types.most_common()),
+            },
+            "latency_ms": {
+                "by_model": {k: v.summary() for k, v in sorted(self.model_latency.items())},
+                "by_model_errors": {k: v.summary() for k, v in sorted(self.model_error_latency.items())},
+                "by_stage": {k: v.summary() for k, v in sorted(self.stage_latency.items())},
+            },
+            "top_users": {
+                "by": "updates" if self.user_updates else "records",
+                "users": dict(users.most_common(self.top)),
+            },
+            "incidents": {
+                "window_seconds": self.window,
+                "windows": [
+                    {"start": _iso(start), **counts} for start, counts in sorted(self.incidents.items())
+                ],
+            },
+        }
+
+
+def error_type(record: Dict[str, Any]) -> str:
+    if record.get("error_type"):
+        return str(record["error_type"])
+    text = f"{record['msg']} {record.get('exc', '')}"
+    match = _EXCEPTION_NAME.search(text)
+    if match:
+        return match.group(1)
+    # Без имени исключения группируем по началу сообщения без чисел
+    prefix = re.sub(r"\d+", "N", record["msg"].split(":", 1)[0])
+    return prefix[:60] or "unknown"
+
+
+def _iso(ts: Optional[float]) -> Optional[str]:
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# --- Вывод ---
+
+def format_text(report: Dict[str, Any]) -> str:
+    lines = [
+        f"Records: {report['records']}  ({report['period']['from']} .. {report['period']['to']})",
+        "Levels: " + ", ".join(f"{k}={v}" for k, v in sorted(report["levels"].items())),
+        "",
+        f"Errors: {report['errors']['total']} ({report['errors']['rate']:.2%})",
+    ]
+    for name, count in report["errors"]["by_type"].items():
+        lines.append(f"  {count:>7}  {name}")
+
+    for title, key in (("Latency by model, ms", "by_model"), ("Latency to error by model, ms", "by_model_errors"),
+                       ("Latency by stage, ms", "by_stage")):
+        rows = report["latency_ms"][key]
+        lines += ["", title]
+        if not rows:
+            lines.append("  (no data)")
+            continue
+        width = max(len(name) for name in rows)
+        lines.append(f"  {'':<{width}}  {'count':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+        for name, s in rows.items():
+            lines.append(f"  {name:<{width}}  {s['count']:>7} {s['p50']:>9} {s['p90']:>9} {s['p99']:>9} {s['max']:>9}")
+
+    lines += ["", f"Top users by {report['top_users']['by']}"]
+    for user_id, count in report["top_users"]["users"].items():
+        lines.append(f"  {count:>7}  {user_id}")
+
+    windows = report["incidents"]["windows"]
+    lines += ["", f"Rate limit / FloodWait incidents ({report['incidents']['window_seconds']}s windows)"]
+    if not windows:
+        lines.append("  (none)")
+    for w in windows:
+        lines.append(f"  {w['start']}  rate_limit={w.get('rate_limit', 0)} flood_wait={w.get('flood_wait', 0)}")
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Анализ логов Sary Bala Bot")
+    parser.add_argument("paths", nargs="+", help="Файлы логов (JSON-массив, JSON lines, текст, .gz); '-' — stdin")
+    parser.add_argument("--format", choices=["text", "json"], default="text", help="Формат отчета")
+    parser.add_argument("--window", type=float, default=5, help="Окно для инцидентов, минуты (по умолчанию 5)")
+    parser.add_argument("--top", type=int, default=10, help="Сколько пользователей показать")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    stats = LogStats(window=max(1, int(args.window * 60)), top=args.top)
+    for path in args.paths:
+        try:
+            with open_log(path) as stream:
+                for record in iter_records(stream):
+                    stats.add(record)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Error reading {path}: {e}", file=sys.stderr)
+            sys.exit(1)
+
+    report = stats.report()
+    if args.format == "json":
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(format_text(report))
+
+
+if __name__ == "__main__":
+    main()
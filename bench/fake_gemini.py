@@ -0,0 +1,175 @@
+"""
+Фейковый клиент google.generativeai для GeminiService(genai=...): стримит ответ
+с заданной задержкой первого токена и скоростью генерации. FakeCacheBackend заменяет
+cachedContents API для ContextCache(backend=...)
+"""
+import asyncio
+import itertools
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+
+class GenerationProfile:
+    def __init__(self, ttft: float = 0.4, tokens_per_sec: float = 50.0,
+                 answer_tokens: int = 200, chunk_tokens: int = 8, prompt_tokens: int = 300):
+        self.ttft = ttft
+        self.tokens_per_sec = tokens_per_sec
+        self.answer_tokens = answer_tokens
+        self.chunk_tokens = chunk_tokens
+        self.prompt_tokens = prompt_tokens
+
+
+class _Usage:
+    def __init__(self, prompt: int, output: int, cached: int = 0):
+        self.prompt_token_count = prompt + cached
+        self.candidates_token_count = output
+        self.cached_content_token_count = cached
+        self.total_token_count = prompt + cached + output
+
+
+class _Chunk:
+    def __init__(self, text: str, usage_metadata: Optional[_Usage] = None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class _Stream:
+    def __init__(self, profile: GenerationProfile, cached_tokens: int = 0):
+        self.profile = profile
+        self.cached_tokens = cached_tokens
+
+    async def __aiter__(self):
+        p = self.profile
+        await asyncio.sleep(p.ttft)
+        sent = 0
+        while sent < p.answer_tokens:
+            n = min(p.chunk_tokens, p.answer_tokens - sent)
+            if sent:
+                await asyncio.sleep(n / p.tokens_per_sec)
+            sent += n
+            # Как и настоящий API, итоговый учет токенов приходит с последним чанком
+            usage = _Usage(p.prompt_tokens, p.answer_tokens, self.cached_tokens) if sent >= p.answer_tokens else None
+            yield _Chunk("слово " * n, usage)
+
+
+class FakeModel:
+    def __init__(self, profile: GenerationProfile, model_name: str = "", cached_tokens: int = 0, **kwargs: Any):
+        self.profile = profile
+        self.model_name = model_name
+        self.cached_tokens = cached_tokens
+
+    async def generate_content_async(self, contents: Any, generation_config: Optional[dict] = None,
+                                     stream: bool = False, **kwargs: Any):
+        if stream:
+            return _Stream(self.profile, self.cached_tokens)
+        text = ""
+        async for chunk in _Stream(self.profile, self.cached_tokens):
+            text += chunk.text
+        return _Chunk(text, _Usage(self.profile.prompt_tokens, self.profile.answer_tokens, self.cached_tokens))
+
+    def start_chat(self, history: Optional[List[dict]] = None, **kwargs: Any) -> "FakeChat":
+        return FakeChat(self)
+
+
+class FakeChat:
+    def __init__(self, model: FakeModel):
+        self.model = model
+
+    async def send_message_async(self, content: Any, generation_config: Optional[dict] = None,
+                                 stream: bool = False, **kwargs: Any):
+        return await self.model.generate_content_async(content, generation_config, stream)
+
+
+class _ModelInfo:
+    def __init__(self, name: str):
+        self.name = f"models/{name}"
+        self.supported_generation_methods = ["generateContent"]
+
+
+class FakeGenai:
+    """Подмножество google.generativeai, которым пользуется GeminiService"""
+
+    MODELS = ("gemini-1.5-flash-latest", "gemini-1.5-pro-latest")
+
+    def __init__(self, profile: GenerationProfile):
+        self.profile = profile
+        self.requests = 0
+
+    def configure(self, **kwargs: Any):
+        pass
+
+    def list_models(self):
+        return [_ModelInfo(name) for name in self.MODELS]
+
+    def GenerativeModel(self, model_name: str = "", **kwargs: Any) -> FakeModel:
+        self.requests += 1
+        return FakeModel(self.profile, model_name, **kwargs)
+
+
+class FakeCachedContent:
+    def __init__(self, name: str, model: str, tokens: int, expires_at: float):
+        self.name = name
+        self.model = model
+        self.tokens = tokens
+        self.expires_at = expires_at
+
+
+class FakeCacheBackend:
+    """
+    cachedContents в памяти с тем же интерфейсом, что services.context_cache.GenaiCacheBackend.
+    Как и настоящий API, забывает кэш по истечении TTL; stats считает созданные, продленные,
+    удаленные и истекшие кэши, а также запросы через кэш (hits) и через уже истекший (expired_uses)
+    """
+
+    def __init__(self, genai: FakeGenai):
+        self.genai = genai
+        self.stats: Counter = Counter()
+        self._live: Dict[str, FakeCachedContent] = {}
+        self._ids = itertools.count(1)
+        # create/extend/delete ContextCache вызывает из потоков
+        self._lock = threading.Lock()
+
+    def _sweep(self, now: float):
+        for name, handle in list(self._live.items()):
+            if handle.expires_at <= now:
+                del self._live[name]
+                self.stats["expired"] += 1
+
+    def _alive(self, handle: FakeCachedContent) -> bool:
+        now = time.monotonic()
+        self._sweep(now)
+        return self._live.get(handle.name) is handle
+
+    def create(self, model: str, system_instruction: Optional[str], contents: List[dict], ttl: int) -> FakeCachedContent:
+        text = (system_instruction or "") + "".join(str(p) for m in contents for p in m["parts"])
+        with self._lock:
+            now = time.monotonic()
+            self._sweep(now)
+            handle = FakeCachedContent(f"cachedContents/{next(self._ids)}", model, len(text) // 3, now + ttl)
+            self._live[handle.name] = handle
+            self.stats["created"] += 1
+        return handle
+
+    def extend(self, handle: FakeCachedContent, ttl: int):
+        with self._lock:
+            if not self._alive(handle):
+                raise RuntimeError(f"404 {handle.name} not found")
+            handle.expires_at = time.monotonic() + ttl
+            self.stats["extended"] += 1
+
+    def delete(self, handle: FakeCachedContent):
+        with self._lock:
+            if self._alive(handle):
+                del self._live[handle.name]
+                self.stats["deleted"] += 1
+
+    def model_for(self, handle: FakeCachedContent) -> FakeModel:
+        with self._lock:
+            if not self._alive(handle):
+                self.stats["expired_uses"] += 1
+                raise RuntimeError(f"404 {handle.name} not found")
+            self.stats["hits"] += 1
+        self.genai.requests += 1
+        return FakeModel(self.genai.profile, handle.model, cached_tokens=handle.tokens)
@@ -0,0 +1,100 @@
+"""
+Локальный фейковый Bot API: отвечает на вызовы бота и запоминает, когда и сколько раз
+редактировалось каждое сообщение
+"""
+import asyncio
+import itertools
+import time
+from typing import Dict, List, Optional
+from aiohttp import web
+
+
+class SentMessage:
+    def __init__(self, chat_id: int, message_id: int, text: str):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.sent_at = time.perf_counter()
+        self.edits: List[float] = []
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.03):
+        self.latency = latency
+        self.files: Dict[str, bytes] = {}
+        self.messages: Dict[int, SentMessage] = {}
+        self.calls: Dict[str, int] = {}
+        self._ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url = ""
+
+    def add_file(self, file_id: str, data: bytes):
+        self.files[file_id] = data
+
+    def messages_since(self, chat_id: int, since: float) -> List[SentMessage]:
+        return [m for m in self.messages.values() if m.chat_id == chat_id and m.sent_at >= since]
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._handle_file)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host=host, port=port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def _message(self, msg: SentMessage) -> dict:
+        return {
+            "message_id": msg.message_id,
+            "date": int(time.time()),
+            "chat": {"id": msg.chat_id, "type": "private"},
+            "text": msg.text,
+        }
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await asyncio.sleep(self.latency)
+        handler = getattr(self, f"_api_{method}", None)
+        # Остальные методы (sendChatAction, answerCallbackQuery...) просто подтверждаем
+        result = handler(params) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    def _api_getMe(self, params: dict) -> dict:
+        return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+    def _api_sendMessage(self, params: dict) -> dict:
+        msg = SentMessage(int(params["chat_id"]), next(self._ids), params.get("text", ""))
+        self.messages[msg.message_id] = msg
+        return self._message(msg)
+
+    def _api_editMessageText(self, params: dict) -> dict:
+        msg = self.messages[int(params["message_id"])]
+        msg.edits.append(time.perf_counter())
+        msg.text = params.get("text", "")
+        return self._message(msg)
+
+    def _api_getFile(self, params: dict) -> dict:
+        file_id = params["file_id"]
+        return {
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "file_size": len(self.files[file_id]),
+            "file_path": f"files/{file_id}",
+        }
+
+    async def _handle_file(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["path"].rsplit("/", 1)[-1]
+        await asyncio.sleep(self.latency)
+        data = self.files.get(file_id)
+        if data is None:
+            return web.json_response({"ok": False, "description": "file not found"}, status=404)
+        return web.Response(body=data)
@@ -1,7 +1,7 @@
 import asyncio
 import os
 from dotenv import load_dotenv
-from services.gemini_service import gemini_service
+from services.gemini_service import get_gemini_service
 
 async def check():
     print("🤖 --- STARTING DIAGNOSTICS ---")
@@ -22,7 +22,7 @@ async def check():
     print("\n🧠 Checking Gemini Brain (Stream).")
     try:
         final_text = ""
-        async for chunk in gemini_service.generate_response_stream(
+        async for chunk in get_gemini_service().generate_response_stream(
             user_id=12345, # Test User
             prompt="Привет! Это тест. Ответь одним словом 'Работаю'."
         ):
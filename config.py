@@ -16,6 +16,114 @@ if not GEMINI_API_KEY:
 # Database settings
 DATABASE_URL = os.getenv("DATABASE_URL")  # Railway PostgreSQL
 
+# FSM storage: "database" (переживает перезапуск, общий для воркеров) или "memory"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "database").lower()
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(24 * 3600)))  # секунды
+# Кэш чтения FSM (секунды) — только в воркерах многопроцессного режима, где пользователь закреплен
+# за процессом. Одиночный процесс и реплики читают из БД: запись могла сделать другая реплика
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "30"))
+
+# Кэш хвоста истории: local — доверять памяти процесса (один процесс или шардирование по user_id),
+# validate — сверять MAX(id) с БД (несколько независимых реплик), off — всегда читать из БД
+HISTORY_CACHE_MODE = os.getenv("HISTORY_CACHE_MODE", "local").lower()
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "10000"))  # пользователей в памяти
+HISTORY_CACHE_DEPTH = int(os.getenv("HISTORY_CACHE_DEPTH", "20"))  # сообщений на пользователя
+
+# Media: файлы до MEDIA_SPILL_THRESHOLD байт обрабатываются в памяти,
+# крупнее — во временной папке (по умолчанию tmpfs /dev/shm, если доступен)
+MEDIA_SPILL_THRESHOLD = int(os.getenv("MEDIA_SPILL_THRESHOLD", str(8 * 1024 * 1024)))
+MEDIA_TEMP_DIR = os.getenv("MEDIA_TEMP_DIR") or ("/dev/shm/sary_bala_bot" if os.path.isdir("/dev/shm") else "temp")
+TEMP_FILE_MAX_AGE = int(os.getenv("TEMP_FILE_MAX_AGE", "3600"))  # секунды
+# Файлы /export (до 50 МБ) пишутся на диск, а не в tmpfs: там они занимали бы память
+EXPORT_TEMP_DIR = os.getenv("EXPORT_TEMP_DIR", "temp")
+
+# Images: фото уменьшаются до IMAGE_MAX_SIDE по длинной стороне и перекодируются в JPEG
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1536"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_CACHE_BYTES = int(os.getenv("IMAGE_CACHE_BYTES", str(64 * 1024 * 1024)))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# Gemini context caching: длинные system_instruction кэшируются на стороне API
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "True").lower() == "true"
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "4096"))
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "3600"))  # секунды
+CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", "100"))
+
+# Response cache: точные повторы запросов при низкой температуре и выключенных tools
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "False").lower() == "true"
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "0.3"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))  # записей в памяти процесса
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))  # секунды
+
+# Метрики Prometheus: локальный эндпоинт /metrics (0 — выключен).
+# Воркеры в многопроцессном режиме слушают METRICS_PORT + 1 + номер воркера
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Трассировка апдейтов: JSON-записи в лог (TRACE_MIN_DURATION_MS — писать только медленные)
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "True").lower() == "true"
+TRACE_MIN_DURATION_MS = float(os.getenv("TRACE_MIN_DURATION_MS", "0"))
+
+# Администраторы (через запятую): доступ к /profile
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "120"))
+
+# Инструмент поиска по истории диалога для модели (работает вместе с остальными tools)
+HISTORY_SEARCH_TOOL = os.getenv("HISTORY_SEARCH_TOOL", "True").lower() == "true"
+
+# Хранение истории: фоновая чистка message_history пачками (0 — без ограничения).
+# HISTORY_MAX_MESSAGES не меньше HISTORY_CACHE_DEPTH, иначе обрезка задела бы кэшированный хвост
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "0"))  # на пользователя
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))  # секунды между проходами
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.05"))  # пауза между пачками, с
+# Папка для архива удаленных сообщений (jsonl.gz); пусто — удалять без архива
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", "")
+# Postgres: message_history секционирована по месяцам (одноразовая миграция при запуске).
+# Новые секции создает та же фоновая задача, даже если лимиты хранения выключены
+HISTORY_PARTITIONING = os.getenv("HISTORY_PARTITIONING", "False").lower() == "true"
+
+# Учет токенов: запись пачками по USAGE_BATCH_SIZE или раз в USAGE_FLUSH_INTERVAL секунд.
+# Дневной бюджет на пользователя в токенах (prompt + output), 0 — без ограничения:
+# сверх мягкого генерация идет на USAGE_DOWNGRADE_MODEL, сверх жесткого откладывается до следующих суток (UTC)
+USAGE_BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", "50"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+USAGE_SOFT_BUDGET = int(os.getenv("USAGE_SOFT_BUDGET", "0"))
+USAGE_HARD_BUDGET = int(os.getenv("USAGE_HARD_BUDGET", "0"))
+USAGE_DOWNGRADE_MODEL = os.getenv("USAGE_DOWNGRADE_MODEL", "gemini-1.5-flash-latest")
+# Сырые записи token_usage чистит задача хранения истории; долгосрочно хранятся дневные суммы (0 — бессрочно).
+# Со значением по умолчанию задача хранения запускается всегда, даже без лимитов истории
+USAGE_RETENTION_DAYS = int(os.getenv("USAGE_RETENTION_DAYS", "90"))
+
+# Run mode: "polling" (по умолчанию, для локального запуска) или "webhook"
+RUN_MODE = os.getenv("RUN_MODE", "polling").lower()
+
+# Число процессов-воркеров. При WORKERS > 1 main.py становится супервизором,
+# который раздает апдейты воркерам по хэшу user_id.
+WORKERS = int(os.getenv("WORKERS", "1"))
+
+# Сколько секунд при остановке ждать генерации, которые еще идут
+SHUTDOWN_GRACE_PERIOD = float(os.getenv("SHUTDOWN_GRACE_PERIOD", "20"))
+
+# Webhook settings
+# Публичный адрес бота. На Railway берется из RAILWAY_PUBLIC_DOMAIN, если не задан явно.
+# Без адреса webhook-режим не запускается: Telegram не узнал бы, куда слать апдейты.
+# WEBHOOK_LOCAL_ONLY=True поднимает сервер без регистрации вебхука (локальные тесты).
+_railway_domain = os.getenv("RAILWAY_PUBLIC_DOMAIN")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL") or (f"https://{_railway_domain}" if _railway_domain else "")
+WEBHOOK_LOCAL_ONLY = os.getenv("WEBHOOK_LOCAL_ONLY", "False").lower() == "true"
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# X-Telegram-Bot-Api-Secret-Token. Если не задан, выводится из BOT_TOKEN: у всех реплик и
+# перезапусков он одинаковый, поэтому вебхук, зарегистрированный любой из них, принимают все
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Сбрасывать ли апдейты, накопившиеся в Telegram, при регистрации вебхука (иначе их доставят после рестарта)
+WEBHOOK_DROP_PENDING_UPDATES = os.getenv("WEBHOOK_DROP_PENDING_UPDATES", "False").lower() == "true"
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "32"))
+
 # Optional settings
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # консоль: text или json; файл всегда JSON lines
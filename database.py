@@ -1,23 +1,69 @@
 import os
+import re
+import sqlite3
+import time
 import aiosqlite
-import asyncpg
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
+from config import HISTORY_CACHE_MODE, HISTORY_CACHE_USERS, HISTORY_CACHE_DEPTH, HISTORY_PARTITIONING
+from metrics import observe_db, HISTORY_CACHE_LOOKUPS
+from history_cache import HistoryCache
 
 # Database setup
 DB_NAME = "bot_database.db"
 DATABASE_URL = os.getenv("DATABASE_URL") # Railway Postgres URL
 
+# Настройки, которые можно менять через update_user_settings, и умолчания переключателей
+USER_SETTINGS = ('username', 'selected_model', 'system_instruction', 'temperature', 'max_tokens', 'use_tools', 'stream_response')
+TOGGLE_DEFAULTS = {"use_tools": False, "stream_response": True}
+# RETURNING появился в SQLite 3.35; на старых версиях upsert дочитывается отдельным SELECT
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Удаление истории идет пачками, чтобы не держать долгую блокировку (SQLite блокирует всю базу)
+DELETE_BATCH_SIZE = 500
+
 logger = logging.getLogger(__name__)
 
+# Полнотекстовый поиск по истории. В Postgres конфигурация russian стеммит и кириллицу, и латиницу
+PG_SEARCH_SQL = """
+    SELECT id, role, timestamp,
+           ts_headline('russian', content, q, 'MaxWords=20, MinWords=8, StartSel=«, StopSel=»') AS snippet
+    FROM message_history, websearch_to_tsquery('russian', $2) q
+    WHERE user_id = $1 AND content_tsv @@ q
+    ORDER BY ts_rank(content_tsv, q) DESC, id DESC
+    LIMIT $3 OFFSET $4
+"""
+# В FTS5 user_id проиндексирован как отдельная колонка: фильтр по пользователю идет по индексу
+SQLITE_SEARCH_SQL = """
+    SELECT m.id, m.role, m.timestamp,
+           snippet(message_history_fts, 0, '«', '»', '…', 12) AS snippet
+    FROM message_history_fts JOIN message_history m ON m.id = message_history_fts.rowid
+    WHERE message_history_fts MATCH ?
+    ORDER BY bm25(message_history_fts, 1.0, 0.0), m.id DESC
+    LIMIT ? OFFSET ?
+"""
+
+
+def fts_query(user_id, text):
+    """Безопасный запрос FTS5: слова пользователя как префиксы, без операторов синтаксиса"""
+    words = re.findall(r"\w+", text)[:10]
+    if not words:
+        return None
+    terms = " ".join(f'"{w}"*' for w in words)
+    return f'user_id : "{int(user_id)}" AND content : ({terms})'
+
 class Database:
     def __init__(self):
         self.type = "postgres" if DATABASE_URL else "sqlite"
         self.pool = None
+        self.history_cache = None
+        if HISTORY_CACHE_MODE != "off":
+            self.history_cache = HistoryCache(max_users=HISTORY_CACHE_USERS, depth=HISTORY_CACHE_DEPTH)
 
     async def connect(self):
         if self.type == "postgres":
             try:
+                import asyncpg
                 self.pool = await asyncpg.create_pool(DATABASE_URL)
                 logger.info("Connected to PostgreSQL")
                 await self.init_postgres()
@@ -29,6 +75,13 @@ class Database:
             logger.info("Using SQLite")
             await self.init_sqlite()
 
+    async def close(self):
+        """Закрывает пул соединений (SQLite открывает соединение на каждый запрос)"""
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+            logger.info("PostgreSQL pool closed")
+
     async def init_postgres(self):
         async with self.pool.acquire() as conn:
             await conn.execute("""
@@ -53,9 +106,168 @@ class Database:
                     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_message_history_user_id ON message_history (user_id, id)")
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_message_history_timestamp ON message_history (timestamp)")
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_storage (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT DEFAULT '{}',
+                    updated_at DOUBLE PRECISION
+                )
+            """)
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated ON fsm_storage (updated_at)")
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT,
+                    created_at DOUBLE PRECISION
+                )
+            """)
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_created ON response_cache (created_at)")
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS token_usage (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_id BIGINT,
+                    model TEXT,
+                    prompt_tokens INTEGER,
+                    output_tokens INTEGER,
+                    cached_tokens INTEGER,
+                    latency_ms REAL,
+                    created_at DOUBLE PRECISION
+                )
+            """)
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_created ON token_usage (created_at)")
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS token_usage_daily (
+                    user_id BIGINT,
+                    day TEXT,
+                    model TEXT,
+                    requests INTEGER DEFAULT 0,
+                    prompt_tokens BIGINT DEFAULT 0,
+                    output_tokens BIGINT DEFAULT 0,
+                    cached_tokens BIGINT DEFAULT 0,
+                    PRIMARY KEY (user_id, day, model)
+                )
+            """)
+            # Поиск: tsvector вычисляется при вставке, GIN-индекс обновляется вместе с таблицей.
+            # На существующей таблице добавление колонки один раз переписывает ее целиком
+            await conn.execute("""
+                ALTER TABLE message_history ADD COLUMN IF NOT EXISTS content_tsv tsvector
+                GENERATED ALWAYS AS (to_tsvector('russian', coalesce(content, ''))) STORED
+            """)
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_message_history_tsv ON message_history USING GIN (content_tsv)")
+            if HISTORY_PARTITIONING:
+                await self._partition_history(conn)
+        if HISTORY_PARTITIONING:
+            await self.ensure_history_partitions()
+
+    async def _partition_history(self, conn):
+        """Одноразовая миграция: обычная message_history -> секционированная по месяцам timestamp"""
+        kind = await conn.fetchval("SELECT relkind FROM pg_class WHERE relname = 'message_history'")
+        if kind == "p":
+            return
+        logger.info("Migrating message_history to monthly partitions...")
+        async with conn.transaction():
+            await conn.execute("LOCK TABLE message_history IN ACCESS EXCLUSIVE MODE")
+            await conn.execute("ALTER TABLE message_history RENAME TO message_history_old")
+            # Имена индексов глобальные: освобождаем их для новой таблицы
+            await conn.execute("ALTER TABLE message_history_old RENAME CONSTRAINT message_history_pkey TO message_history_old_pkey")
+            await conn.execute("DROP INDEX IF EXISTS idx_message_history_user_id")
+            await conn.execute("DROP INDEX IF EXISTS idx_message_history_tsv")
+            await conn.execute("DROP INDEX IF EXISTS idx_message_history_timestamp")
+            await conn.execute("""
+                CREATE TABLE message_history (
+                    id BIGINT NOT NULL DEFAULT nextval('message_history_id_seq'),
+                    user_id BIGINT REFERENCES users(user_id),
+                    role TEXT,
+                    content TEXT,
+                    has_media BOOLEAN DEFAULT FALSE,
+                    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    content_tsv tsvector GENERATED ALWAYS AS (to_tsvector('russian', coalesce(content, ''))) STORED,
+                    PRIMARY KEY (id, timestamp)
+                ) PARTITION BY RANGE (timestamp)
+            """)
+            # Последовательность иначе удалится вместе со старой таблицей
+            await conn.execute("ALTER SEQUENCE message_history_id_seq OWNED BY message_history.id")
+            oldest = await conn.fetchval("SELECT MIN(timestamp) FROM message_history_old")
+            await self._create_partitions(conn, oldest or datetime.utcnow(), datetime.utcnow() + timedelta(days=92))
+            await conn.execute("""
+                INSERT INTO message_history (id, user_id, role, content, has_media, timestamp)
+                SELECT id, user_id, role, content, has_media, COALESCE(timestamp, CURRENT_TIMESTAMP)
+                FROM message_history_old
+            """)
+            await conn.execute("DROP TABLE message_history_old")
+            await conn.execute("CREATE INDEX idx_message_history_user_id ON message_history (user_id, id)")
+            await conn.execute("CREATE INDEX idx_message_history_tsv ON message_history USING GIN (content_tsv)")
+            await conn.execute("CREATE INDEX idx_message_history_timestamp ON message_history (timestamp)")
+        logger.info("message_history is now partitioned by month")
+
+    @staticmethod
+    def _partition_name(month):
+        return f"message_history_y{month.year}m{month.month:02d}"
+
+    @staticmethod
+    def _next_month(month):
+        return (month.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+    async def _create_partitions(self, conn, start, end):
+        month = datetime(start.year, start.month, 1)
+        while month <= end:
+            following = self._next_month(month)
+            await conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self._partition_name(month)} PARTITION OF message_history "
+                f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"
+            )
+            month = following
+
+    async def ensure_history_partitions(self, months_ahead=3):
+        """Секции на текущий и следующие месяцы: вставка в несуществующую секцию упадет"""
+        if self.type != "postgres" or not HISTORY_PARTITIONING:
+            return
+        now = datetime.utcnow()
+        async with self.pool.acquire() as conn:
+            await self._create_partitions(conn, now, now + timedelta(days=31 * months_ahead))
+
+    async def list_history_partitions(self):
+        """[(имя, начало месяца, начало следующего)] секций message_history по возрастанию"""
+        if self.type != "postgres" or not HISTORY_PARTITIONING:
+            return []
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                JOIN pg_class p ON p.oid = i.inhparent
+                WHERE p.relname = 'message_history'
+            """)
+        partitions = []
+        for row in rows:
+            match = re.fullmatch(r"message_history_y(\d{4})m(\d{2})", row["relname"])
+            if match:
+                month = datetime(int(match.group(1)), int(match.group(2)), 1)
+                partitions.append((row["relname"], month, self._next_month(month)))
+        return sorted(partitions, key=lambda p: p[1])
+
+    async def read_partition_batch(self, partition, after_id, batch_size=DELETE_BATCH_SIZE):
+        """Строки секции по возрастанию id (для архивации перед удалением секции)"""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT id, user_id, role, content, has_media, timestamp FROM {partition} "
+                f"WHERE id > $1 ORDER BY id LIMIT $2", after_id, batch_size
+            )
+            return [dict(r) for r in rows]
+
+    async def drop_history_partition(self, partition):
+        """Удаление секции целиком: мгновенно, без построчного DELETE"""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(f"ALTER TABLE message_history DETACH PARTITION {partition}")
+                await conn.execute(f"DROP TABLE {partition}")
 
     async def init_sqlite(self):
         async with aiosqlite.connect(DB_NAME) as db:
+            # WAL позволяет нескольким процессам-воркерам читать, пока кто-то пишет
+            await db.execute("PRAGMA journal_mode=WAL")
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY,
@@ -85,8 +297,86 @@ class Database:
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_message_history_user_id ON message_history (user_id, id)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_message_history_timestamp ON message_history (timestamp)")
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_storage (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT DEFAULT '{}',
+                    updated_at REAL
+                )
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated ON fsm_storage (updated_at)")
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT,
+                    created_at REAL
+                )
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_created ON response_cache (created_at)")
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS token_usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    model TEXT,
+                    prompt_tokens INTEGER,
+                    output_tokens INTEGER,
+                    cached_tokens INTEGER,
+                    latency_ms REAL,
+                    created_at REAL
+                )
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_created ON token_usage (created_at)")
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS token_usage_daily (
+                    user_id INTEGER,
+                    day TEXT,
+                    model TEXT,
+                    requests INTEGER DEFAULT 0,
+                    prompt_tokens INTEGER DEFAULT 0,
+                    output_tokens INTEGER DEFAULT 0,
+                    cached_tokens INTEGER DEFAULT 0,
+                    PRIMARY KEY (user_id, day, model)
+                )
+            """)
+            await self._init_sqlite_fts(db)
             await db.commit()
 
+    async def _init_sqlite_fts(self, db):
+        """FTS5-индекс над message_history, который поддерживают триггеры"""
+        async with db.execute("SELECT 1 FROM sqlite_master WHERE name = 'message_history_fts'") as cursor:
+            existed = await cursor.fetchone() is not None
+        try:
+            await db.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS message_history_fts USING fts5(
+                    content, user_id, content='message_history', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+            """)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"FTS5 is not available, history search disabled: {e}")
+            return
+        await db.executescript("""
+            CREATE TRIGGER IF NOT EXISTS message_history_fts_ai AFTER INSERT ON message_history BEGIN
+                INSERT INTO message_history_fts(rowid, content, user_id) VALUES (new.id, new.content, new.user_id);
+            END;
+            CREATE TRIGGER IF NOT EXISTS message_history_fts_ad AFTER DELETE ON message_history BEGIN
+                INSERT INTO message_history_fts(message_history_fts, rowid, content, user_id)
+                VALUES ('delete', old.id, old.content, old.user_id);
+            END;
+            CREATE TRIGGER IF NOT EXISTS message_history_fts_au AFTER UPDATE ON message_history BEGIN
+                INSERT INTO message_history_fts(message_history_fts, rowid, content, user_id)
+                VALUES ('delete', old.id, old.content, old.user_id);
+                INSERT INTO message_history_fts(rowid, content, user_id) VALUES (new.id, new.content, new.user_id);
+            END;
+        """)
+        if not existed:
+            # Индекс появился на уже заполненной таблице: строим его один раз по всем строкам
+            await db.execute("INSERT INTO message_history_fts(message_history_fts) VALUES ('rebuild')")
+
+    @observe_db
     async def get_user_settings(self, user_id):
         if self.type == "postgres":
             async with self.pool.acquire() as conn:
@@ -111,65 +401,484 @@ class Database:
         }
 
     async def update_user_setting(self, user_id, setting, value):
-        # Whitelist allowed settings
-        allowed_settings = ['username', 'selected_model', 'system_instruction', 'temperature', 'max_tokens', 'use_tools', 'stream_response']
-        if setting not in allowed_settings:
-            return
+        await self.update_user_settings(user_id, {setting: value})
+
+    @observe_db
+    async def update_user_settings(self, user_id, changes=None, toggles=()):
+        """
+        Одним upsert: записывает changes, инвертирует булевы toggles прямо в SQL
+        и возвращает обновленную строку users целиком
+        """
+        changes = {k: v for k, v in (changes or {}).items() if k in USER_SETTINGS}
+        toggles = [t for t in toggles if t in TOGGLE_DEFAULTS and t not in changes]
+        if not changes and not toggles:
+            return await self.get_user_settings(user_id)
 
+        columns = list(changes) + toggles
+        # Новый пользователь: переключатель получает значение, противоположное умолчанию
+        values = list(changes.values()) + [not TOGGLE_DEFAULTS[t] for t in toggles]
         if self.type == "postgres":
+            sets = [f"{c} = EXCLUDED.{c}" for c in changes]
+            sets += [f"{t} = NOT COALESCE(users.{t}, {TOGGLE_DEFAULTS[t]})" for t in toggles]
+            placeholders = ", ".join(f"${i + 2}" for i in range(len(columns)))
             async with self.pool.acquire() as conn:
-                # Upsert logic
-                await conn.execute(f"""
-                    INSERT INTO users (user_id, {setting}) VALUES ($1, $2)
-                    ON CONFLICT (user_id) DO UPDATE SET {setting} = $2
-                """, user_id, value)
+                row = await conn.fetchrow(f"""
+                    INSERT INTO users (user_id, {", ".join(columns)}) VALUES ($1, {placeholders})
+                    ON CONFLICT (user_id) DO UPDATE SET {", ".join(sets)}
+                    RETURNING *
+                """, user_id, *values)
+                return dict(row)
         else:
+            sets = [f"{c} = excluded.{c}" for c in changes]
+            sets += [f"{t} = NOT COALESCE(users.{t}, {int(TOGGLE_DEFAULTS[t])})" for t in toggles]
+            upsert = f"""
+                INSERT INTO users (user_id, {", ".join(columns)}) VALUES (?{", ?" * len(columns)})
+                ON CONFLICT (user_id) DO UPDATE SET {", ".join(sets)}
+            """
             async with aiosqlite.connect(DB_NAME) as db:
-                await db.execute(f"INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-                await db.execute(f"UPDATE users SET {setting} = ? WHERE user_id = ?", (value, user_id))
+                db.row_factory = aiosqlite.Row
+                if SQLITE_RETURNING:
+                    async with db.execute(upsert + " RETURNING *", (user_id, *values)) as cursor:
+                        row = await cursor.fetchone()
+                else:
+                    await db.execute(upsert, (user_id, *values))
+                    async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+                        row = await cursor.fetchone()
                 await db.commit()
+                return dict(row)
 
+    @observe_db
     async def save_message(self, user_id, role, content, has_media=False):
         if self.type == "postgres":
             async with self.pool.acquire() as conn:
-                await conn.execute("""
+                message_id = await conn.fetchval("""
                     INSERT INTO message_history (user_id, role, content, has_media) 
-                    VALUES ($1, $2, $3, $4)
+                    VALUES ($1, $2, $3, $4) RETURNING id
                 """, user_id, role, content, has_media)
         else:
             async with aiosqlite.connect(DB_NAME) as db:
-                await db.execute("""
+                cursor = await db.execute("""
                     INSERT INTO message_history (user_id, role, content, has_media) 
                     VALUES (?, ?, ?, ?)
                 """, (user_id, role, content, int(has_media)))
+                message_id = cursor.lastrowid
                 await db.commit()
+        if self.history_cache is not None:
+            self.history_cache.append(user_id, {"role": role, "content": content}, message_id)
+        return message_id
 
     async def get_chat_history(self, user_id, limit=10):
+        """Последние limit сообщений в хронологическом порядке; активных пользователей отдает из кэша"""
+        cache = self.history_cache
+        if cache is None:
+            return [{"role": r["role"], "content": r["content"]} for r in await self.load_chat_history(user_id, limit)]
+
+        cached = cache.get(user_id, limit)
+        if cached is not None:
+            if HISTORY_CACHE_MODE != "validate" or cache.last_id(user_id) == await self.latest_message_id(user_id):
+                HISTORY_CACHE_LOOKUPS.inc(result="hit")
+                return cached
+            HISTORY_CACHE_LOOKUPS.inc(result="stale")
+        else:
+            HISTORY_CACHE_LOOKUPS.inc(result="miss")
+
+        # При промахе читаем сразу на глубину буфера, чтобы следующие ходы попадали в кэш
+        depth = max(limit, cache.depth)
+        rows = None
+        cache.begin_fill(user_id)
+        try:
+            rows = await self.load_chat_history(user_id, depth)
+        finally:
+            messages = None if rows is None else [{"role": r["role"], "content": r["content"]} for r in rows]
+            cache.end_fill(user_id, messages, depth, rows[-1]["id"] if rows else None)
+        return messages[-limit:] if limit > 0 else []
+
+    @observe_db
+    async def load_chat_history(self, user_id, limit=10):
+        """Чтение хвоста истории из БД мимо кэша: [{id, role, content}]"""
         if self.type == "postgres":
             async with self.pool.acquire() as conn:
                 rows = await conn.fetch("""
-                    SELECT role, content FROM message_history 
-                    WHERE user_id = $1 ORDER BY timestamp DESC LIMIT $2
+                    SELECT id, role, content FROM message_history 
+                    WHERE user_id = $1 ORDER BY id DESC LIMIT $2
                 """, user_id, limit)
                 return [dict(r) for r in reversed(rows)]
         else:
             async with aiosqlite.connect(DB_NAME) as db:
                 db.row_factory = aiosqlite.Row
                 async with db.execute("""
-                    SELECT role, content FROM message_history 
-                    WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?
+                    SELECT id, role, content FROM message_history 
+                    WHERE user_id = ? ORDER BY id DESC LIMIT ?
                 """, (user_id, limit)) as cursor:
                     rows = await cursor.fetchall()
                     return [dict(r) for r in reversed(rows)]
 
+    @observe_db
+    async def latest_message_id(self, user_id):
+        """MAX(id) истории пользователя: дешевая проверка свежести кэша по индексу (user_id, id)"""
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                return await conn.fetchval("SELECT MAX(id) FROM message_history WHERE user_id = $1", user_id)
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                async with db.execute("SELECT MAX(id) FROM message_history WHERE user_id = ?", (user_id,)) as cursor:
+                    row = await cursor.fetchone()
+                    return row[0]
+
+    async def iter_chat_history(self, user_id, batch_size=500):
+        """
+        Вся история пользователя по возрастанию id, по одной записи: курсор на стороне сервера
+        (asyncpg) или построчное чтение курсора (aiosqlite), в памяти не больше batch_size строк.
+        Асинхронный генератор, поэтому без @observe_db.
+        """
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                # Курсоры asyncpg работают только внутри транзакции
+                async with conn.transaction(readonly=True):
+                    async for row in conn.cursor("""
+                        SELECT id, role, content, has_media, timestamp FROM message_history
+                        WHERE user_id = $1 ORDER BY id
+                    """, user_id, prefetch=batch_size):
+                        yield dict(row)
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                db.row_factory = aiosqlite.Row
+                async with db.execute("""
+                    SELECT id, role, content, has_media, timestamp FROM message_history
+                    WHERE user_id = ? ORDER BY id
+                """, (user_id,)) as cursor:
+                    cursor.iter_chunk_size = batch_size
+                    async for row in cursor:
+                        yield dict(row)
+
     async def clear_chat_history(self, user_id):
+        # Без @observe_db: каждый запрос ниже учитывается в метриках сам, по одному разу.
+        # Пачками и только до последнего сообщения на момент вызова: новые сообщения не трогаем
+        last_id = await self.latest_message_id(user_id)
+        if last_id is not None:
+            while True:
+                ids = await self.get_history_ids(user_id, last_id, DELETE_BATCH_SIZE)
+                await self.delete_history_by_ids(ids)
+                if len(ids) < DELETE_BATCH_SIZE:
+                    break
+        if self.history_cache is not None:
+            self.history_cache.drop(user_id)
+
+    @observe_db
+    async def get_history_ids(self, user_id, up_to_id, limit):
+        """Самые старые id сообщений пользователя, не новее up_to_id"""
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT id FROM message_history WHERE user_id = $1 AND id <= $2 ORDER BY id LIMIT $3
+                """, user_id, up_to_id, limit)
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                async with db.execute("""
+                    SELECT id FROM message_history WHERE user_id = ? AND id <= ? ORDER BY id LIMIT ?
+                """, (user_id, up_to_id, limit)) as cursor:
+                    rows = await cursor.fetchall()
+        return [r[0] for r in rows]
+
+    @observe_db
+    async def get_expired_history(self, older_than, batch_size=DELETE_BATCH_SIZE):
+        """Самые старые сообщения с timestamp < older_than (datetime, UTC), по индексу idx_message_history_timestamp"""
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT id, user_id, role, content, has_media, timestamp FROM message_history
+                    WHERE timestamp < $1 ORDER BY timestamp LIMIT $2
+                """, older_than, batch_size)
+                return [dict(r) for r in rows]
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                db.row_factory = aiosqlite.Row
+                async with db.execute("""
+                    SELECT id, user_id, role, content, has_media, timestamp FROM message_history
+                    WHERE timestamp < ? ORDER BY timestamp LIMIT ?
+                """, (older_than.strftime("%Y-%m-%d %H:%M:%S"), batch_size)) as cursor:
+                    return [dict(r) for r in await cursor.fetchall()]
+
+    @observe_db
+    async def max_history_id(self):
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                return await conn.fetchval("SELECT COALESCE(MAX(id), 0) FROM message_history")
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                async with db.execute("SELECT COALESCE(MAX(id), 0) FROM message_history") as cursor:
+                    return (await cursor.fetchone())[0]
+
+    @observe_db
+    async def get_users_over_history_limit(self, keep, after_id=0, limit=1000):
+        """
+        Пользователи, у которых сообщений больше keep, среди писавших после сообщения after_id.
+        Проверяется наличие (keep + 1)-го с конца сообщения по индексу (user_id, id), без подсчета всей таблицы
+        """
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT u.user_id FROM (SELECT DISTINCT user_id FROM message_history WHERE id > $2) u
+                    WHERE EXISTS (
+                        SELECT 1 FROM message_history m WHERE m.user_id = u.user_id ORDER BY m.id DESC OFFSET $1 LIMIT 1
+                    ) LIMIT $3
+                """, keep, after_id, limit)
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                async with db.execute("""
+                    SELECT u.user_id FROM (SELECT DISTINCT user_id FROM message_history WHERE id > ?) u
+                    WHERE EXISTS (
+                        SELECT 1 FROM message_history m WHERE m.user_id = u.user_id ORDER BY m.id DESC LIMIT 1 OFFSET ?
+                    ) LIMIT ?
+                """, (after_id, keep, limit)) as cursor:
+                    rows = await cursor.fetchall()
+        return [r[0] for r in rows]
+
+    @observe_db
+    async def get_excess_history(self, user_id, keep, batch_size=DELETE_BATCH_SIZE):
+        """Самые старые сообщения пользователя сверх последних keep"""
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT id, user_id, role, content, has_media, timestamp FROM message_history
+                    WHERE user_id = $1 AND id < (
+                        SELECT id FROM message_history WHERE user_id = $1 ORDER BY id DESC OFFSET $2 - 1 LIMIT 1
+                    ) ORDER BY id LIMIT $3
+                """, user_id, keep, batch_size)
+                return [dict(r) for r in rows]
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                db.row_factory = aiosqlite.Row
+                async with db.execute("""
+                    SELECT id, user_id, role, content, has_media, timestamp FROM message_history
+                    WHERE user_id = ? AND id < (
+                        SELECT id FROM message_history WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ? - 1
+                    ) ORDER BY id LIMIT ?
+                """, (user_id, user_id, keep, batch_size)) as cursor:
+                    return [dict(r) for r in await cursor.fetchall()]
+
+    @observe_db
+    async def delete_history_by_ids(self, ids):
+        if not ids:
+            return
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                await conn.execute("DELETE FROM message_history WHERE id = ANY($1::bigint[])", list(ids))
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                placeholders = ",".join("?" * len(ids))
+                await db.execute(f"DELETE FROM message_history WHERE id IN ({placeholders})", list(ids))
+                await db.commit()
+
+    @observe_db
+    async def search_history(self, user_id, query, limit=5, offset=0):
+        """Полнотекстовый поиск по истории пользователя: [{id, role, timestamp, snippet}] по релевантности"""
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(PG_SEARCH_SQL, user_id, query, limit, offset)
+                return [dict(r) for r in rows]
+        else:
+            match = fts_query(user_id, query)
+            if match is None:
+                return []
+            async with aiosqlite.connect(DB_NAME) as db:
+                db.row_factory = aiosqlite.Row
+                async with db.execute(SQLITE_SEARCH_SQL, (match, limit, offset)) as cursor:
+                    return [dict(r) for r in await cursor.fetchall()]
+
+    @observe_db
+    async def get_fsm_record(self, key):
+        """Возвращает (state, data_json) для ключа FSM или None"""
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                row = await conn.fetchrow("SELECT state, data FROM fsm_storage WHERE key = $1", key)
+                return (row["state"], row["data"]) if row else None
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                async with db.execute("SELECT state, data FROM fsm_storage WHERE key = ?", (key,)) as cursor:
+                    row = await cursor.fetchone()
+                    return (row[0], row[1]) if row else None
+
+    @observe_db
+    async def set_fsm_state(self, key, state, updated_at):
+        """Меняет только состояние FSM: данные, записанные другим процессом, не затираются"""
+        await self._set_fsm_column(key, "state", state, None, updated_at)
+
+    @observe_db
+    async def set_fsm_data(self, key, data, updated_at):
+        """Меняет только данные FSM (JSON-строка)"""
+        await self._set_fsm_column(key, "data", data, "{}", updated_at)
+
+    async def _set_fsm_column(self, key, column, value, empty, updated_at):
+        """Upsert одной колонки; запись без состояния и данных удаляется"""
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(f"""
+                        INSERT INTO fsm_storage (key, {column}, updated_at) VALUES ($1, $2, $3)
+                        ON CONFLICT (key) DO UPDATE SET {column} = $2, updated_at = $3
+                    """, key, value, updated_at)
+                    if value == empty:
+                        await conn.execute(
+                            "DELETE FROM fsm_storage WHERE key = $1 AND state IS NULL AND data = '{}'", key
+                        )
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                await db.execute(f"""
+                    INSERT INTO fsm_storage (key, {column}, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at
+                """, (key, value, updated_at))
+                if value == empty:
+                    await db.execute("DELETE FROM fsm_storage WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+                await db.commit()
+
+    @observe_db
+    async def delete_expired_fsm(self, older_than, batch_size=500):
+        """Удаляет до batch_size записей FSM, не обновлявшихся с older_than. Возвращает число удаленных"""
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                result = await conn.execute("""
+                    DELETE FROM fsm_storage WHERE key IN (
+                        SELECT key FROM fsm_storage WHERE updated_at < $1 LIMIT $2
+                    )
+                """, older_than, batch_size)
+                return int(result.split()[-1])
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                cursor = await db.execute("""
+                    DELETE FROM fsm_storage WHERE key IN (
+                        SELECT key FROM fsm_storage WHERE updated_at < ? LIMIT ?
+                    )
+                """, (older_than, batch_size))
+                await db.commit()
+                return cursor.rowcount
+
+    @observe_db
+    async def get_cached_response(self, key, not_before):
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                return await conn.fetchval(
+                    "SELECT response FROM response_cache WHERE key = $1 AND created_at >= $2", key, not_before
+                )
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                async with db.execute(
+                    "SELECT response FROM response_cache WHERE key = ? AND created_at >= ?", (key, not_before)
+                ) as cursor:
+                    row = await cursor.fetchone()
+                    return row[0] if row else None
+
+    @observe_db
+    async def put_cached_response(self, key, response, created_at):
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                await conn.execute("""
+                    INSERT INTO response_cache (key, response, created_at) VALUES ($1, $2, $3)
+                    ON CONFLICT (key) DO UPDATE SET response = $2, created_at = $3
+                """, key, response, created_at)
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                await db.execute("""
+                    INSERT INTO response_cache (key, response, created_at) VALUES (?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET response = excluded.response, created_at = excluded.created_at
+                """, (key, response, created_at))
+                await db.commit()
+
+    @observe_db
+    async def prune_response_cache(self, older_than):
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                await conn.execute("DELETE FROM response_cache WHERE created_at < $1", older_than)
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                await db.execute("DELETE FROM response_cache WHERE created_at < ?", (older_than,))
+                await db.commit()
+
+    @observe_db
+    async def record_token_usage(self, records):
+        """
+        Пачка записей (user_id, model, prompt, output, cached, latency_ms, created_at) одной транзакцией:
+        сырые строки в token_usage и инкремент дневных сумм в token_usage_daily
+        """
+        daily = {}
+        for user_id, model, prompt, output, cached, _, created_at in records:
+            key = (user_id, time.strftime("%Y-%m-%d", time.gmtime(created_at)), model)
+            total = daily.setdefault(key, [0, 0, 0, 0])
+            total[0] += 1
+            total[1] += prompt
+            total[2] += output
+            total[3] += cached
+        rollups = [(*key, *total) for key, total in daily.items()]
+
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.executemany("""
+                        INSERT INTO token_usage (user_id, model, prompt_tokens, output_tokens, cached_tokens, latency_ms, created_at)
+                        VALUES ($1, $2, $3, $4, $5, $6, $7)
+                    """, records)
+                    await conn.executemany("""
+                        INSERT INTO token_usage_daily (user_id, day, model, requests, prompt_tokens, output_tokens, cached_tokens)
+                        VALUES ($1, $2, $3, $4, $5, $6, $7)
+                        ON CONFLICT (user_id, day, model) DO UPDATE SET
+                            requests = token_usage_daily.requests + EXCLUDED.requests,
+                            prompt_tokens = token_usage_daily.prompt_tokens + EXCLUDED.prompt_tokens,
+                            output_tokens = token_usage_daily.output_tokens + EXCLUDED.output_tokens,
+                            cached_tokens = token_usage_daily.cached_tokens + EXCLUDED.cached_tokens
+                    """, rollups)
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                await db.executemany("""
+                    INSERT INTO token_usage (user_id, model, prompt_tokens, output_tokens, cached_tokens, latency_ms, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, records)
+                await db.executemany("""
+                    INSERT INTO token_usage_daily (user_id, day, model, requests, prompt_tokens, output_tokens, cached_tokens)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id, day, model) DO UPDATE SET
+                        requests = requests + excluded.requests,
+                        prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                        output_tokens = output_tokens + excluded.output_tokens,
+                        cached_tokens = cached_tokens + excluded.cached_tokens
+                """, rollups)
+                await db.commit()
+
+    @observe_db
+    async def delete_expired_token_usage(self, older_than, batch_size=500):
+        """Удаляет до batch_size сырых записей token_usage старше older_than (unix time); дневные суммы остаются"""
         if self.type == "postgres":
             async with self.pool.acquire() as conn:
-                await conn.execute("DELETE FROM message_history WHERE user_id = $1", user_id)
+                result = await conn.execute("""
+                    DELETE FROM token_usage WHERE id IN (
+                        SELECT id FROM token_usage WHERE created_at < $1 ORDER BY id LIMIT $2
+                    )
+                """, older_than, batch_size)
+                return int(result.split()[-1])
         else:
             async with aiosqlite.connect(DB_NAME) as db:
-                await db.execute("DELETE FROM message_history WHERE user_id = ?", (user_id,))
+                cursor = await db.execute("""
+                    DELETE FROM token_usage WHERE id IN (
+                        SELECT id FROM token_usage WHERE created_at < ? ORDER BY id LIMIT ?
+                    )
+                """, (older_than, batch_size))
                 await db.commit()
+                return cursor.rowcount
+
+    @observe_db
+    async def get_daily_tokens(self, user_id, day):
+        """Токены пользователя за день (prompt + output) по всем моделям"""
+        if self.type == "postgres":
+            async with self.pool.acquire() as conn:
+                total = await conn.fetchval("""
+                    SELECT SUM(prompt_tokens + output_tokens) FROM token_usage_daily WHERE user_id = $1 AND day = $2
+                """, user_id, day)
+        else:
+            async with aiosqlite.connect(DB_NAME) as db:
+                async with db.execute("""
+                    SELECT SUM(prompt_tokens + output_tokens) FROM token_usage_daily WHERE user_id = ? AND day = ?
+                """, (user_id, day)) as cursor:
+                    total = (await cursor.fetchone())[0]
+        return int(total or 0)
 
 db = Database()
 
@@ -177,17 +886,29 @@ db = Database()
 async def init_db():
     await db.connect()
 
+async def close_db():
+    await db.close()
+
 async def get_user_settings(user_id):
     return await db.get_user_settings(user_id)
 
 async def update_user_setting(user_id, setting, value):
     await db.update_user_setting(user_id, setting, value)
 
+async def update_user_settings(user_id, changes=None, toggles=()):
+    return await db.update_user_settings(user_id, changes, toggles)
+
 async def save_message(user_id, role, content, has_media=False):
-    await db.save_message(user_id, role, content, has_media)
+    return await db.save_message(user_id, role, content, has_media)
 
 async def get_chat_history(user_id, limit=10):
     return await db.get_chat_history(user_id, limit)
 
 async def clear_chat_history(user_id):
     await db.clear_chat_history(user_id)
+
+async def search_history(user_id, query, limit=5, offset=0):
+    return await db.search_history(user_id, query, limit, offset)
+
+def iter_chat_history(user_id, batch_size=500):
+    return db.iter_chat_history(user_id, batch_size)
@@ -0,0 +1,139 @@
+"""
+FSM-хранилище aiogram поверх database.Database (SQLite/Postgres)
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional, Tuple
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from database import db as default_db
+
+logger = logging.getLogger(__name__)
+
+# Маркер "эту половину записи не меняли" для обновления кэша
+_KEEP = object()
+
+
+class DatabaseStorage(BaseStorage):
+    """
+    Состояния переживают перезапуск и доступны всем процессам, работающим с той же БД.
+    Состояние и данные пишутся в БД независимо друг от друга, без чтения перед записью.
+    """
+
+    def __init__(
+        self,
+        database=default_db,
+        cache_ttl: float = 0.0,
+        cache_size: int = 10000,
+        state_ttl: float = 24 * 3600,
+        cleanup_interval: float = 600.0,
+        cleanup_batch: int = 500,
+    ):
+        """
+        Args:
+            cache_ttl: Сколько секунд запись из кэша считается свежей; 0 — всегда читать из БД.
+                Кэш допустим, только если пользователь закреплен за этим процессом
+                (воркеры многопроцессного режима): иначе другая реплика могла изменить запись
+            cache_size: Максимум записей в кэше процесса
+            state_ttl: Через сколько секунд без изменений состояние считается брошенным
+            cleanup_interval: Период фоновой очистки устаревших состояний
+            cleanup_batch: Сколько записей удалять за один запрос
+        """
+        self.db = database
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.state_ttl = state_ttl
+        self.cleanup_interval = cleanup_interval
+        self.cleanup_batch = cleanup_batch
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        # key -> (loaded_at, state, data)
+        self._cache: "OrderedDict[str, Tuple[float, Optional[str], Dict[str, Any]]]" = OrderedDict()
+        self._cleanup_task: Optional[asyncio.Task] = None
+
+    def _remember(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        if self.cache_ttl <= 0:
+            return
+        self._cache[key] = (time.monotonic(), state, data)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        cached = self._cache.get(key)
+        if cached and time.monotonic() - cached[0] < self.cache_ttl:
+            self._cache.move_to_end(key)
+            return cached[1], cached[2]
+        record = await self.db.get_fsm_record(key)
+        state, data = (record[0], json.loads(record[1] or "{}")) if record else (None, {})
+        self._remember(key, state, data)
+        return state, data
+
+    def _update_cached(self, key: str, state: Any = _KEEP, data: Any = _KEEP):
+        """Запись в кэше обновляется, только пока она свежая: вторая половина берется из нее же"""
+        cached = self._cache.pop(key, None)
+        if cached and time.monotonic() - cached[0] < self.cache_ttl:
+            self._remember(
+                key,
+                cached[1] if state is _KEEP else state,
+                cached[2] if data is _KEEP else data,
+            )
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self.key_builder.build(key)
+        state = state.state if isinstance(state, State) else state
+        await self.db.set_fsm_state(k, state, time.time())
+        self._update_cached(k, state=state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        k = self.key_builder.build(key)
+        data = data.copy()
+        await self.db.set_fsm_data(k, json.dumps(data, ensure_ascii=False), time.time())
+        self._update_cached(k, data=data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self.key_builder.build(key))
+        return data.copy()
+
+    async def start(self):
+        """Запускает фоновую очистку устаревших состояний (регистрируется в dp.startup)"""
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def _cleanup_loop(self):
+        while True:
+            try:
+                deleted = await self.expire_stale()
+                if deleted:
+                    logger.info(f"Expired {deleted} stale FSM states")
+            except Exception as e:
+                logger.error(f"FSM cleanup error: {e}")
+            await asyncio.sleep(self.cleanup_interval)
+
+    async def expire_stale(self) -> int:
+        """Удаляет брошенные состояния пачками, чтобы не держать долгую блокировку таблицы"""
+        older_than = time.time() - self.state_ttl
+        total = 0
+        while True:
+            deleted = await self.db.delete_expired_fsm(older_than, self.cleanup_batch)
+            total += deleted
+            if deleted < self.cleanup_batch:
+                break
+            await asyncio.sleep(0)
+        return total
+
+    async def close(self) -> None:
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+        self._cache.clear()
@@ -0,0 +1,50 @@
+import re
+import time
+from aiogram import Router, F
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message, BufferedInputFile
+from config import ADMIN_IDS, PROFILE_MAX_SECONDS
+from profiler import profile, ProfilerBusy
+from logger_config import get_logger
+
+router = Router()
+# Команды этого роутера видят только администраторы, остальным они уходят в обычный чат
+router.message.filter(F.from_user.id.in_(ADMIN_IDS))
+logger = get_logger()
+
+_DURATION_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*(s|m)?$")
+
+
+def parse_duration(text: str, default: float = 30.0) -> float:
+    """'30s', '2m', '15' -> секунды"""
+    if not text:
+        return default
+    match = _DURATION_RE.match(text.strip().lower())
+    if not match:
+        raise ValueError(text)
+    value = float(match.group(1))
+    return value * 60 if match.group(2) == "m" else value
+
+
+@router.message(Command("profile"))
+async def profile_command(message: Message, command: CommandObject):
+    try:
+        seconds = parse_duration(command.args)
+    except ValueError:
+        await message.answer("Формат: /profile 30s (или 2m)")
+        return
+    seconds = min(max(seconds, 1.0), PROFILE_MAX_SECONDS)
+
+    await message.answer(f"🔬 Снимаю профиль {seconds:g} сек...")
+    logger.info(f"Profiling requested by {message.from_user.id} for {seconds:g}s")
+    try:
+        folded = await profile(seconds)
+    except ProfilerBusy:
+        await message.answer("Профайлер уже запущен, дождитесь результата.")
+        return
+
+    filename = f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+    await message.answer_document(
+        BufferedInputFile(folded.encode(), filename=filename),
+        caption="Folded stacks: откройте в speedscope.app или flamegraph.pl"
+    )
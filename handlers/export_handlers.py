@@ -0,0 +1,98 @@
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import time
+from aiogram import Router
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message, FSInputFile
+from config import EXPORT_TEMP_DIR
+from database import iter_chat_history
+from logger_config import get_logger
+
+router = Router()
+logger = get_logger()
+
+EXPORT_FORMATS = {"jsonl": "jsonl", "json": "jsonl", "md": "md", "markdown": "md"}
+# Строк в одной записи в файл: сжатие идет в отдельном потоке, а не в event loop
+WRITE_BATCH = 500
+# Лимит Bot API на отправку документа
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+# Пользователи, у которых выгрузка уже идет
+_running = set()
+
+
+def format_row(row: dict, fmt: str) -> str:
+    if fmt == "jsonl":
+        return json.dumps(row, ensure_ascii=False, default=str) + "\n"
+    who = "👤 Вы" if row["role"] == "user" else "🤖 Бот"
+    media = " 📎" if row["has_media"] else ""
+    return f"### {who} · {str(row['timestamp'])[:16]}{media}\n\n{row['content'] or ''}\n\n"
+
+
+async def write_export(user_id: int, fmt: str, path: str) -> int:
+    """Пишет историю в gzip-файл по мере чтения курсора; возвращает число сообщений"""
+    count = 0
+    f = await asyncio.to_thread(gzip.open, path, "wt", encoding="utf-8")
+    try:
+        lines = ["# История диалога\n\n"] if fmt == "md" else []
+        async for row in iter_chat_history(user_id, WRITE_BATCH):
+            lines.append(format_row(row, fmt))
+            count += 1
+            if len(lines) >= WRITE_BATCH:
+                await asyncio.to_thread(f.writelines, lines)
+                lines = []
+        if lines:
+            await asyncio.to_thread(f.writelines, lines)
+    finally:
+        await asyncio.to_thread(f.close)
+    return count
+
+
+@router.message(Command("export"))
+async def export_command(message: Message, command: CommandObject):
+    user_id = message.from_user.id
+    fmt = EXPORT_FORMATS.get((command.args or "jsonl").strip().lower())
+    if fmt is None:
+        await message.answer("Использование: /export [jsonl|md]")
+        return
+    if user_id in _running:
+        await message.answer("⏳ Выгрузка уже готовится, подождите.")
+        return
+
+    _running.add(user_id)
+    path = None
+    status = await message.answer("⏳ Готовлю выгрузку истории...")
+    try:
+        os.makedirs(EXPORT_TEMP_DIR, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix=f"export-{user_id}-", suffix=f".{fmt}.gz", dir=EXPORT_TEMP_DIR)
+        os.close(fd)
+        started = time.perf_counter()
+        count = await write_export(user_id, fmt, path)
+        if count == 0:
+            await status.edit_text("История пуста — выгружать нечего.")
+            return
+        size = os.path.getsize(path)
+        if size > TELEGRAM_DOCUMENT_LIMIT:
+            await status.edit_text("Выгрузка больше 50 МБ и не может быть отправлена в Telegram 😞")
+            return
+        logger.info(f"History export: {count} messages, {size} bytes", extra={
+            "user_id": user_id, "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+        })
+        await message.answer_document(
+            FSInputFile(path, filename=f"history-{user_id}.{fmt}.gz"),
+            caption=f"📦 История диалога: {count} сообщений",
+        )
+        await status.delete()
+    except Exception as e:
+        logger.error(f"Export error: {e}", extra={"user_id": user_id})
+        await status.edit_text("Не удалось выгрузить историю 😞")
+    finally:
+        _running.discard(user_id)
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,69 @@
+from aiogram import Router, F
+from aiogram.filters import Command, CommandObject
+from aiogram.fsm.context import FSMContext
+from aiogram.types import Message, CallbackQuery
+from database import search_history
+from keyboards.search_kb import get_search_kb
+from logger_config import get_logger
+
+router = Router()
+logger = get_logger()
+
+PAGE_SIZE = 5
+SNIPPET_LIMIT = 300
+
+
+async def render_page(user_id: int, query: str, page: int):
+    """Текст страницы результатов и клавиатура листания"""
+    # Берем на одну запись больше, чтобы знать, есть ли следующая страница
+    rows = await search_history(user_id, query, PAGE_SIZE + 1, page * PAGE_SIZE)
+    has_next = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+
+    if not rows:
+        text = f"🔎 По запросу «{query}» ничего не найдено." if page == 0 else "🔎 Больше результатов нет."
+        return text, get_search_kb(page, False)
+
+    lines = [f"🔎 «{query}» — стр. {page + 1}"]
+    for row in rows:
+        icon = "👤" if row["role"] == "user" else "🤖"
+        snippet = row["snippet"] or ""
+        if len(snippet) > SNIPPET_LIMIT:
+            snippet = snippet[:SNIPPET_LIMIT] + "…"
+        lines.append(f"\n{icon} {str(row['timestamp'])[:16]}\n{snippet}")
+    return "\n".join(lines), get_search_kb(page, has_next)
+
+
+@router.message(Command("search"))
+async def search_command(message: Message, command: CommandObject, state: FSMContext):
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("Использование: /search <что искать в истории>")
+        return
+
+    await state.update_data(search_query=query)
+    try:
+        text, kb = await render_page(message.from_user.id, query, 0)
+    except Exception as e:
+        logger.error(f"Search error: {e}", extra={"user_id": message.from_user.id})
+        await message.answer("Поиск по истории сейчас недоступен 😞")
+        return
+    await message.answer(text, reply_markup=kb, parse_mode=None)
+
+
+@router.callback_query(F.data.startswith("search_page_"))
+async def search_page(callback: CallbackQuery, state: FSMContext):
+    query = (await state.get_data()).get("search_query")
+    if not query:
+        await callback.answer("Поиск устарел, повторите /search", show_alert=True)
+        return
+
+    page = max(0, int(callback.data.replace("search_page_", "")))
+    try:
+        text, kb = await render_page(callback.from_user.id, query, page)
+    except Exception as e:
+        logger.error(f"Search error: {e}", extra={"user_id": callback.from_user.id})
+        await callback.answer("Поиск сейчас недоступен", show_alert=True)
+        return
+    await callback.message.edit_text(text, reply_markup=kb, parse_mode=None)
+    await callback.answer()
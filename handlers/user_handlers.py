@@ -1,22 +1,20 @@
-import io
-import os
-import PIL.Image
 import asyncio
 from aiogram import Router, F, Bot
 from aiogram.filters import CommandStart
 from aiogram.types import Message, ContentType
-from services.gemini_service import gemini_service
+from aiogram.exceptions import TelegramRetryAfter
+from services.gemini_service import get_gemini_service
+from services.media_service import MediaFile, download_media
+from services.image_service import prepare_photo
 from keyboards.settings_kb import main_kb
-from database import clear_history, get_user_settings
+from database import clear_chat_history, get_user_settings
 from logger_config import get_logger
+from lifecycle import inflight
+from metrics import TELEGRAM_EDITS, TELEGRAM_EDITS_PER_MESSAGE
 
 router = Router()
 logger = get_logger()
 
-# Создаем папку для временных файлов
-if not os.path.exists("temp"):
-    os.makedirs("temp")
-
 @router.message(CommandStart())
 async def command_start(message: Message):
     await message.answer(
@@ -33,7 +31,7 @@ async def command_start(message: Message):
 
 @router.message(F.text == "🗑 Очистить память")
 async def clear_mem(message: Message):
-    await clear_history(message.from_user.id)
+    await clear_chat_history(message.from_user.id)
     await message.answer("История диалога очищена! 🧠✨")
 
 @router.message(F.text == "ℹ️ О боте")
@@ -56,21 +54,16 @@ async def voice_handler(message: Message, bot: Bot):
     # Логика та же, но используем stream handler
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
     
-    file_id = message.voice.file_id if message.voice else message.audio.file_id
-    file = await bot.get_file(file_id)
-    file_ext = file.file_path.split('.')[-1]
-    local_filename = f"temp/{file_id}.{file_ext}"
-    
-    await bot.download_file(file.file_path, local_filename)
+    media = message.voice or message.audio
+    audio = await download_media(bot, media.file_id, media.mime_type or "audio/ogg", media.file_size)
     
     try:
-        await handle_response_stream(message, prompt=message.caption or "", audio_path=local_filename)
+        await handle_response_stream(message, prompt=message.caption or "", audio=audio)
     except Exception as e:
         await message.answer("Ошибка обработки аудио 😞")
         logger.error(f"Voice error: {e}")
     finally:
-        if os.path.exists(local_filename):
-            os.remove(local_filename)
+        audio.cleanup()
 
 @router.message()
 async def chat_handler(message: Message, bot: Bot):
@@ -81,14 +74,8 @@ async def chat_handler(message: Message, bot: Bot):
     prompt = message.text or (message.caption if message.caption else "")
 
     if message.photo:
-        photo = message.photo[-1]
-        file_info = await bot.get_file(photo.file_id)
-        file_stream = io.BytesIO()
-        await bot.download_file(file_info.file_path, destination=file_stream)
-        file_stream.seek(0)
         try:
-            img = PIL.Image.open(file_stream)
-            images.append(img)
+            images.append(await prepare_photo(bot, message.photo))
             if not prompt: prompt = "Опиши это."
         except Exception as e:
             logger.error(f"Error processing image: {e}")
@@ -97,44 +84,70 @@ async def chat_handler(message: Message, bot: Bot):
 
     await handle_response_stream(message, prompt, images)
 
-async def handle_response_stream(message: Message, prompt: str, images: list = None, audio_path: str = None):
+async def handle_response_stream(message: Message, prompt: str, images: list = None, audio: MediaFile = None):
     """Общий обработчик с поддержкой стриминга и защитой от FloodWait"""
     
     answer_msg = await message.answer("⏳ Думаю...")
     
+    chunk_text = ""
     last_text = ""
     last_update_time = 0
     import time
+    edits = {"ok": 0, "failed": 0}
+
+    async def edit(text: str, **kwargs):
+        try:
+            await answer_msg.edit_text(text, **kwargs)
+        except Exception as e:
+            TELEGRAM_EDITS.inc(result="flood_wait" if isinstance(e, TelegramRetryAfter) else "failed")
+            edits["failed"] += 1
+            raise
+        TELEGRAM_EDITS.inc(result="ok")
+        edits["ok"] += 1
     
-    try:
-        async for chunk_text in gemini_service.generate_response_stream(
-            message.from_user.id, prompt, images, audio_path
-        ):
-            # Telegram разрешает редактировать сообщение не чаще чем раз в ~1-2 сек (для разных чатов по-разному, но безопасно раз в 1.5с)
-            current_time = time.time()
+    stream = get_gemini_service().generate_response_stream(
+        message.from_user.id, prompt, images, audio
+    )
+    with inflight.track():
+        try:
+            async for chunk_text in stream:
+                # Telegram разрешает редактировать сообщение не чаще чем раз в ~1-2 сек (для разных чатов по-разному, но безопасно раз в 1.5с)
+                current_time = time.time()
+                
+                # Обновляем, если прошло > 1.0 сек ИЛИ текст изменился значительно (>50 симв)
+                if (current_time - last_update_time > 1.0) or (len(chunk_text) - len(last_text) > 100):
+                    try:
+                        await edit(chunk_text + " ▌") 
+                        last_text = chunk_text
+                        last_update_time = current_time
+                    except Exception:
+                        pass 
             
-            # Обновляем, если прошло > 1.0 сек ИЛИ текст изменился значительно (>50 симв)
-            if (current_time - last_update_time > 1.0) or (len(chunk_text) - len(last_text) > 100):
+            # Финальное обновление
+            if last_text != chunk_text:
                 try:
-                    await answer_msg.edit_text(chunk_text + " ▌") 
-                    last_text = chunk_text
-                    last_update_time = current_time
+                    await edit(chunk_text, parse_mode="Markdown")
                 except Exception:
-                    pass 
+                    # Если Markdown сломался, отправляем как есть
+                    await edit(chunk_text, parse_mode=None)
+            else:
+                try:
+                    await edit(chunk_text, parse_mode="Markdown")
+                except Exception:
+                    await edit(chunk_text, parse_mode=None)
             
-        # Финальное обновление
-        if last_text != chunk_text:
-            try:
-                await answer_msg.edit_text(chunk_text, parse_mode="Markdown")
-            except Exception:
-                # Если Markdown сломался, отправляем как есть
-                await answer_msg.edit_text(chunk_text, parse_mode=None)
-        else:
+        except asyncio.CancelledError:
+            # Бот останавливается: генератор сохраняет ход, а пользователь видит, что ответ оборван
+            await stream.aclose()
+            notice = "⚠️ Бот перезапускается, ответ прерван. Повторите запрос чуть позже."
             try:
-                await answer_msg.edit_text(chunk_text, parse_mode="Markdown")
+                await edit(f"{chunk_text}\n\n{notice}" if chunk_text else notice, parse_mode=None)
             except Exception:
-                await answer_msg.edit_text(chunk_text, parse_mode=None)
-            
-    except Exception as e:
-        logger.error(f"Handler error: {e}")
-        await answer_msg.edit_text(f"Произошла ошибка: {e}")
+                pass
+            raise
+        except Exception as e:
+            logger.error(f"Handler error: {e}", extra={"user_id": message.from_user.id, "error_type": type(e).__name__})
+            await edit(f"Произошла ошибка: {e}")
+        finally:
+            for result, count in edits.items():
+                TELEGRAM_EDITS_PER_MESSAGE.observe(count, result=result)
@@ -0,0 +1,92 @@
+"""
+Кэш последних сообщений активных пользователей: кольцевой буфер на пользователя, LRU между пользователями
+"""
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+
+class _Entry:
+    def __init__(self, messages: List[dict], depth: int, complete: bool, last_id: Optional[int]):
+        self.messages = deque(messages, maxlen=depth)
+        # В буфере вся история пользователя (ее меньше depth), а не только хвост
+        self.complete = complete
+        self.last_id = last_id
+
+
+class HistoryCache:
+    """
+    Хвост истории в памяти процесса. Запись в БД дописывает буфер, очистка истории его удаляет,
+    чтение идет в БД только при промахе.
+
+    Буфер заполняется только если за время чтения из БД у пользователя не было записей:
+    иначе прочитанный хвост мог уже устареть.
+    """
+
+    def __init__(self, max_users: int = 10000, depth: int = 20):
+        self.max_users = max_users
+        self.depth = depth
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        # user_id -> [число идущих чтений, была ли запись во время чтения]
+        self._fills: Dict[int, list] = {}
+
+    def get(self, user_id: int, limit: int) -> Optional[List[dict]]:
+        entry = self._entries.get(user_id)
+        if entry is None or limit > self.depth:
+            return None
+        if len(entry.messages) < limit and not entry.complete:
+            return None
+        self._entries.move_to_end(user_id)
+        messages = list(entry.messages)[-limit:] if limit > 0 else []
+        return [dict(m) for m in messages]
+
+    def last_id(self, user_id: int) -> Optional[int]:
+        entry = self._entries.get(user_id)
+        return entry.last_id if entry else None
+
+    def begin_fill(self, user_id: int):
+        state = self._fills.setdefault(user_id, [0, False])
+        state[0] += 1
+
+    def end_fill(self, user_id: int, messages: Optional[List[dict]] = None,
+                 limit: int = 0, last_id: Optional[int] = None):
+        """Завершает чтение из БД; messages=None — чтение не удалось, кэш не трогаем"""
+        state = self._fills[user_id]
+        state[0] -= 1
+        dirty = state[1]
+        if state[0] == 0:
+            del self._fills[user_id]
+        if dirty or messages is None or limit > self.depth:
+            return
+        self._entries[user_id] = _Entry(
+            [dict(m) for m in messages], self.depth, len(messages) < limit, last_id
+        )
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def append(self, user_id: int, message: dict, message_id: Optional[int]):
+        self._mark_dirty(user_id)
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        # Параллельное чтение из БД уже могло захватить это сообщение
+        if message_id is not None and entry.last_id is not None and message_id <= entry.last_id:
+            return
+        if entry.complete and len(entry.messages) == self.depth:
+            entry.complete = False
+        entry.messages.append(dict(message))
+        entry.last_id = message_id
+
+    def drop(self, user_id: int):
+        self._mark_dirty(user_id)
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        for state in self._fills.values():
+            state[1] = True
+        self._entries.clear()
+
+    def _mark_dirty(self, user_id: int):
+        state = self._fills.get(user_id)
+        if state:
+            state[1] = True
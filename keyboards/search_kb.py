@@ -0,0 +1,11 @@
+from typing import Optional
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+# Листание результатов /search; сам запрос хранится в данных FSM
+def get_search_kb(page: int, has_next: bool) -> Optional[InlineKeyboardMarkup]:
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"search_page_{page - 1}"))
+    if has_next:
+        row.append(InlineKeyboardButton(text="Дальше ▶️", callback_data=f"search_page_{page + 1}"))
+    return InlineKeyboardMarkup(inline_keyboard=[row]) if row else None
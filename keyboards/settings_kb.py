@@ -1,5 +1,5 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from services.gemini_service import gemini_service
+from services.gemini_service import get_gemini_service
 
 # Главное меню (Reply)
 main_kb = ReplyKeyboardMarkup(
@@ -30,7 +30,7 @@ def get_settings_kb(settings: dict):
 
 # Остальные функции те же...
 def get_models_kb():
-    models = gemini_service.available_models
+    models = get_gemini_service().available_models
     buttons = []
     for m in models:
         buttons.append([InlineKeyboardButton(text=m, callback_data=f"set_model_{m}")])
@@ -0,0 +1,133 @@
+"""
+Жизненный цикл процесса: замер запуска, прием апдейтов, сигналы остановки и учет генераций, которые еще идут
+"""
+import asyncio
+import logging
+import signal
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Set, Tuple, TypeVar
+from aiogram import Bot
+from aiogram.types import Update
+from aiogram.utils.backoff import Backoff, BackoffConfig
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+
+class InflightTracker:
+    """Учитывает задачи, которые сейчас генерируют ответ пользователю"""
+
+    def __init__(self):
+        self._tasks: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    @contextmanager
+    def track(self):
+        """Регистрирует текущую задачу на время генерации"""
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            yield
+        finally:
+            self._tasks.discard(task)
+
+    async def drain(self, timeout: float, abort_timeout: float = 5.0) -> Tuple[int, int]:
+        """
+        Ждет завершения генераций не дольше timeout, оставшиеся отменяет.
+
+        Отмененным задачам дается abort_timeout на то, чтобы дописать сообщение
+        в Telegram и сохранить ход в БД. Возвращает (успели, прерваны).
+        """
+        pending = set(self._tasks)
+        if not pending:
+            return 0, 0
+        logger.info(f"Waiting up to {timeout}s for {len(pending)} in-flight generations")
+        done, pending = await asyncio.wait(pending, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending, timeout=abort_timeout)
+        return len(done), len(pending)
+
+
+inflight = InflightTracker()
+
+
+class StartupReport:
+    """Замеряет длительность этапов запуска и пишет сводку в лог"""
+
+    def __init__(self, started: Optional[float] = None):
+        """
+        Args:
+            started: time.perf_counter() в начале процесса; время до создания отчета
+                записывается как этап "imports"
+        """
+        self.started = started if started is not None else time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+        if started is not None:
+            self.phases.append(("imports", time.perf_counter() - started))
+
+    @contextmanager
+    def phase(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - t0))
+
+    async def measure(self, name: str, awaitable: Awaitable[T]) -> T:
+        """Замер для этапов, которые идут параллельно через asyncio.gather"""
+        with self.phase(name):
+            return await awaitable
+
+    def log(self, label: str = "Startup"):
+        total = (time.perf_counter() - self.started) * 1000
+        parts = ", ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.phases)
+        logger.info(f"{label} report: total={total:.0f}ms; {parts}")
+
+
+def install_stop_handlers(callback: Callable[[], None]):
+    """Вызывает callback по SIGINT/SIGTERM (на Windows остается KeyboardInterrupt)"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, callback)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+
+async def drain_inflight(timeout: float):
+    """Дожидается текущих генераций и пишет в лог, сколько успело завершиться"""
+    drained, aborted = await inflight.drain(timeout)
+    logger.info(f"Shutdown: {drained} generations drained, {aborted} aborted")
+
+
+async def listen_updates(bot: Bot, allowed_updates: Optional[List[str]] = None,
+                         polling_timeout: int = 30) -> AsyncIterator[Update]:
+    """
+    Бесконечный цикл getUpdates: ошибки сети и Bot API переживаются с backoff.
+    Вместо dp.start_polling, чтобы остановка приема апдейтов не запускала сразу dp.shutdown
+    """
+    backoff = Backoff(BackoffConfig(min_delay=1.0, max_delay=5.0, factor=1.3, jitter=0.1))
+    # Таймаут запроса больше таймаута long polling, иначе пустой ответ выглядел бы как ошибка
+    request_timeout = int((bot.session.timeout or 60) + polling_timeout)
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset, timeout=polling_timeout, allowed_updates=allowed_updates,
+                request_timeout=request_timeout,
+            )
+        except Exception as e:
+            logger.error(f"Failed to fetch updates: {type(e).__name__}: {e}; retrying in {backoff.next_delay:.1f}s")
+            await backoff.asleep()
+            continue
+        backoff.reset()
+        for update in updates:
+            yield update
+            # Подтверждаем апдейт следующим getUpdates только после того, как он передан дальше
+            offset = update.update_id + 1
@@ -1,28 +1,104 @@
+import atexit
+import json
 import logging
 import os
-from logging.handlers import RotatingFileHandler
-
-# Создаем папку для логов если нет
-if not os.path.exists("logs"):
-    os.makedirs("logs")
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
 
 # Настройка логгера
 logger = logging.getLogger("sary_bala_bot")
 logger.setLevel(logging.INFO)
 
-# Форматтер
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Атрибуты, которые есть у любой LogRecord; все остальное пришло через extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON. Поля из extra (user_id, model, latency_ms...) попадают в запись как есть"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """В очередь кладется запись с уже подставленными args, но без форматирования в текст"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # traceback не сериализуется между потоками без форматирования
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level: str = "INFO", log_name: str = "bot", console_format: str = "text"):
+    """
+    Единая настройка логов процесса. Вызывается на этапе запуска, а не при импорте модуля.
+
+    Логгеры пишут только в очередь; файл (JSON lines, с ротацией) и консоль обслуживает
+    QueueListener в отдельном потоке, поэтому запись логов не блокирует event loop.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    # Создаем папку для логов если нет
+    os.makedirs("logs", exist_ok=True)
+
+    # Файловый хендлер (ротация 10МБ, хранить 5 файлов). Каждый процесс пишет в свой файл
+    file_handler = RotatingFileHandler(f"logs/{log_name}.log", maxBytes=10*1024*1024, backupCount=5, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+
+    # Консольный хендлер (stdout, чтобы Railway видел логи)
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(JsonFormatter() if console_format == "json" else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(log_queue))
+    root.setLevel(level.upper())
+    logger.setLevel(level.upper())
+
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
 
-# Файловый хендлер (ротация 10МБ, хранить 5 файлов)
-file_handler = RotatingFileHandler("logs/bot.log", maxBytes=10*1024*1024, backupCount=5, encoding='utf-8')
-file_handler.setFormatter(formatter)
 
-# Консольный хендлер
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
+def stop_logging():
+    """Дописывает очередь и закрывает файлы. Вызывается при остановке процесса"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
 
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
 
 def get_logger():
     return logger
@@ -1,37 +1,75 @@
+import time
+
+_boot_started = time.perf_counter()
+
+import argparse
 import asyncio
 import logging
 import sys
-import os
-import glob
 from aiogram import Bot, Dispatcher
-from config import BOT_TOKEN
-from handlers import user_handlers, settings_handlers
-from database import init_db
-
-# Настройка логгера для вывода в stdout (стобы Railway видел логи)
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    stream=sys.stdout
+from config import (
+    BOT_TOKEN, RUN_MODE, WORKERS, WEBHOOK_BASE_URL, WEBHOOK_LOCAL_ONLY, FSM_STORAGE, FSM_STATE_TTL, FSM_CACHE_TTL, SHUTDOWN_GRACE_PERIOD,
+    METRICS_HOST, METRICS_PORT, TRACING_ENABLED, TRACE_MIN_DURATION_MS, LOG_LEVEL, LOG_FORMAT
 )
+from database import init_db, close_db
+from lifecycle import StartupReport, drain_inflight, install_stop_handlers, listen_updates
+from logger_config import setup_logging, stop_logging
+from metrics import start_metrics_server
+
+# Хендлеры настраивает setup_logging() на этапе запуска
 logger = logging.getLogger("main")
 
-def clear_temp_folder():
-    """Очищает папку temp при запуске"""
-    temp_dir = "temp"
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-        return
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sary Bala Bot")
+    parser.add_argument(
+        "--mode", choices=["polling", "webhook"], default=RUN_MODE,
+        help="Способ получения апдейтов (по умолчанию RUN_MODE или polling)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=WORKERS,
+        help="Число процессов-воркеров (по умолчанию WORKERS или 1)"
+    )
+    return parser.parse_args()
 
-    files = glob.glob(os.path.join(temp_dir, "*"))
-    for f in files:
-        try:
-            os.remove(f)
-            logger.info(f"Deleted temp file: {f}")
-        except Exception as e:
-            logger.error(f"Error deleting {f}: {e}")
+def create_bot() -> Bot:
+    from middleware import TelegramRateLimitMiddleware
+    from tracing import TelegramTracingMiddleware
+
+    bot = Bot(token=BOT_TOKEN)
+    bot.session.middleware(TelegramTracingMiddleware())
+    bot.session.middleware(TelegramRateLimitMiddleware())
+    return bot
+
+def create_dispatcher(pinned_users: bool = False) -> Dispatcher:
+    """pinned_users — все апдейты пользователя приходят в этот процесс (воркер шардирования)"""
+    from handlers import admin_handlers, export_handlers, search_handlers, user_handlers, settings_handlers
+    from services.media_service import temp_janitor
+    from services.usage_service import usage_recorder
+    from tracing import TracingMiddleware
 
-async def main():
+    if FSM_STORAGE == "database":
+        from fsm_storage import DatabaseStorage
+        # Кэш FSM только в воркерах: иначе другая реплика могла изменить состояние пользователя
+        storage = DatabaseStorage(cache_ttl=FSM_CACHE_TTL if pinned_users else 0, state_ttl=FSM_STATE_TTL)
+        dp = Dispatcher(storage=storage)
+        dp.startup.register(storage.start)
+    else:
+        dp = Dispatcher()
+    dp.update.outer_middleware(TracingMiddleware(TRACING_ENABLED, TRACE_MIN_DURATION_MS))
+    dp.include_router(admin_handlers.router)
+    dp.include_router(settings_handlers.router) 
+    dp.include_router(search_handlers.router)
+    dp.include_router(export_handlers.router)
+    dp.include_router(user_handlers.router)
+    # Старые временные файлы убираются в фоне, а не синхронно при запуске
+    dp.startup.register(temp_janitor.start)
+    dp.shutdown.register(temp_janitor.stop)
+    # Учет токенов пишется пачками; остаток сбрасывается при остановке
+    dp.startup.register(usage_recorder.start)
+    dp.shutdown.register(usage_recorder.stop)
+    return dp
+
+async def init_database():
     logger.info("Initializing database...")
     
     # Обработка ошибок инициализации БД
@@ -42,29 +80,104 @@ async def main():
         logger.error(f"Database initialization failed: {e}")
         logger.error("Bot cannot start without database. Exiting...")
         sys.exit(1)
-    
-    # Очистка временных файлов
-    clear_temp_folder()
-    
-    logger.info("Starting bot...")
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher()
 
-    dp.include_router(settings_handlers.router) 
-    dp.include_router(user_handlers.router)
+def init_services():
+    from services.gemini_service import get_gemini_service
+    get_gemini_service()
+
+async def startup(report: StartupReport, with_services: bool = True, log_name: str = "bot",
+                  pinned_users: bool = False):
+    """Явный этап запуска: БД, сервисы и диспетчер. Возвращает (bot, dp)"""
+    setup_logging(LOG_LEVEL, log_name, LOG_FORMAT)
+    phases = [report.measure("init_db", init_database())]
+    if with_services:
+        # Список моделей Gemini запрашивается по сети, поэтому идет параллельно с БД
+        phases.append(report.measure("gemini_service", asyncio.to_thread(init_services)))
+    await asyncio.gather(*phases)
+
+    with report.phase("dispatcher"):
+        bot = create_bot()
+        dp = create_dispatcher(pinned_users)
+    return bot, dp
+
+async def run_polling(bot: Bot, dp: Dispatcher):
+    """
+    Polling в одном процессе. При остановке сначала прекращается прием апдейтов и дописываются
+    генерации, и только потом dp.shutdown закрывает FSM и сбрасывает учет токенов
+    (dp.start_polling вызывает shutdown сразу после остановки приема)
+    """
+    tasks = set()
+
+    async def process(update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.error(f"Failed to process update {update.update_id}: {e}")
+
+    async def receive():
+        async for update in listen_updates(bot, dp.resolve_used_update_types()):
+            task = asyncio.create_task(process(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    logger.info("Bot is running! 🚀")
+    await dp.emit_startup(bot=bot)
+    try:
+        polling = asyncio.create_task(receive())
+        install_stop_handlers(polling.cancel)
+        try:
+            await polling
+        except asyncio.CancelledError:
+            logger.info("Polling stopped")
+        await drain_inflight(SHUTDOWN_GRACE_PERIOD)
+        if tasks:
+            await asyncio.wait(tasks, timeout=5)
+    finally:
+        await dp.emit_shutdown(bot=bot)
+
+async def main(mode: str = "polling", workers: int = 1):
+    report = StartupReport(started=_boot_started)
+    # Супервизору сервисы не нужны: генерацией занимаются воркеры
+    bot, dp = await startup(report, with_services=workers <= 1)
+    report.log()
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    # Чистка истории идет в единственном процессе: супервизоре или одиночном боте
+    from services.retention_service import retention_job
+    await retention_job.start()
     
+    logger.info("Starting bot...")
     try:
-        await dp.start_polling(bot)
+        if workers > 1:
+            from sharding import run_sharded
+            await run_sharded(bot, dp, mode, workers)
+        elif mode == "webhook":
+            from webhook_server import run_webhook
+            logger.info("Bot is running in webhook mode! 🚀")
+            await run_webhook(bot, dp)
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            logger.info("Bot is running! 🚀")
+            await run_polling(bot, dp)
     except Exception as e:
-        logger.error(f"Polling error: {e}")
+        logger.error(f"{mode.capitalize()} error: {e}")
     finally:
+        await retention_job.stop()
+        # Генерации, дописанные после остановки диспетчера, тоже попадают в учет
+        from services.usage_service import usage_recorder
+        await usage_recorder.flush()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await close_db()
         await bot.session.close()
+        logger.info("Bot stopped")
+        stop_logging()
 
 if __name__ == "__main__":
+    args = parse_args()
+    if args.mode == "webhook" and not WEBHOOK_BASE_URL and not WEBHOOK_LOCAL_ONLY:
+        # Иначе процесс "здоров", но апдейты в него не приходят
+        sys.exit("Webhook mode requires WEBHOOK_BASE_URL (or RAILWAY_PUBLIC_DOMAIN); "
+                 "set WEBHOOK_LOCAL_ONLY=True to run without registering the webhook")
     try:
-        asyncio.run(main())
+        asyncio.run(main(args.mode, args.workers))
     except KeyboardInterrupt:
         print("Bot stopped")
@@ -0,0 +1,220 @@
+"""
+Метрики в формате Prometheus: счетчики, гистограммы и HTTP-эндпоинт /metrics
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        # Метрики обновляются и из пула потоков (tools, картинки)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self._values: Dict[Tuple[str, ...], float] = {}
+        super().__init__(name, documentation, labels)
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # key -> [счетчики по корзинам..., +Inf], сумма
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        super().__init__(name, documentation, labels)
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            total[0] += value
+
+    def total(self) -> int:
+        """Число наблюдений по всем меткам"""
+        with self._lock:
+            return sum(sum(counts) for counts, _ in self._values.values())
+
+    @contextmanager
+    def time(self, **labels: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    labels = _format_labels(self.label_names, key, 'le="%s"' % le)
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {total[0]}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Метрики бота ---
+
+GENERATION_TTFT = Histogram(
+    "bot_generation_ttft_seconds", "Time from request to the first streamed token", ["model"]
+)
+GENERATION_DURATION = Histogram(
+    "bot_generation_seconds", "Total generation time", ["model"]
+)
+DB_LATENCY = Histogram(
+    "bot_db_query_seconds", "Database method latency", ["backend", "method"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+TELEGRAM_EDITS = Counter(
+    "bot_telegram_edits_total", "Telegram edit_text calls by result", ["result"]
+)
+TELEGRAM_EDITS_PER_MESSAGE = Histogram(
+    "bot_telegram_edits_per_message", "edit_text calls per answer message", ["result"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+)
+TOOL_LATENCY = Histogram(
+    "bot_tool_seconds", "Tool call latency", ["tool"]
+)
+HISTORY_CACHE_LOOKUPS = Counter(
+    "bot_history_cache_lookups_total", "Chat history cache lookups by result", ["result"]
+)
+RATE_LIMIT_REJECTIONS = Counter(
+    "bot_rate_limit_rejections_total", "Requests rejected by rate limits by source (gemini, telegram, middleware)",
+    ["source"]
+)
+GENERATION_TOKENS = Counter(
+    "bot_generation_tokens_total", "Gemini tokens by model and kind (prompt, output, cached)", ["model", "kind"]
+)
+USAGE_ADMISSIONS = Counter(
+    "bot_usage_budget_actions_total", "Generations downgraded or deferred by the token budget", ["action"]
+)
+
+
+def observe_db(func):
+    """Декоратор для методов database.Database: латентность по бэкенду и методу + span трассы"""
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            with span(f"db.{func.__name__}", backend=self.type):
+                return await func(self, *args, **kwargs)
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - t0, backend=self.type, method=func.__name__)
+    return wrapper
+
+
+def observe_tool(func):
+    """Декоратор для функций-инструментов (синхронных и async); сигнатура сохраняется для Gemini"""
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with TOOL_LATENCY.time(tool=func.__name__), span(f"tool.{func.__name__}"):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with TOOL_LATENCY.time(tool=func.__name__), span(f"tool.{func.__name__}"):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+async def start_metrics_server(host: str, port: int) -> Optional["web.AppRunner"]:
+    """Поднимает отдельный HTTP-сервер с /metrics. Порт 0 отключает эндпоинт"""
+    if not port:
+        return None
+    from aiohttp import web
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host=host, port=port).start()
+    except OSError as e:
+        logger.error(f"Metrics server failed to start on {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
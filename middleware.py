@@ -5,8 +5,11 @@ import time
 from collections import defaultdict
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.types import Message
 import logging
+from metrics import RATE_LIMIT_REJECTIONS
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +50,7 @@ class RateLimitMiddleware(BaseMiddleware):
                 f"Лимит: {self.rate_limit} запросов в {self.time_window} сек."
             )
             logger.warning(f"Rate limit exceeded for user {user_id}")
+            RATE_LIMIT_REJECTIONS.inc(source="middleware")
             return
 
         # Добавляем запрос
@@ -55,6 +59,17 @@ class RateLimitMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 
+class TelegramRateLimitMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: считает отказы Bot API с RetryAfter (flood control)"""
+
+    async def __call__(self, make_request, bot, method):
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            RATE_LIMIT_REJECTIONS.inc(source="telegram")
+            raise
+
+
 class ValidationMiddleware(BaseMiddleware):
     """Валидация входящих данных"""
 
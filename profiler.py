@@ -0,0 +1,54 @@
+"""
+Сэмплирующий профайлер процесса: стеки всех потоков через sys._current_frames()
+в формате folded stacks (flamegraph.pl, speedscope)
+"""
+import asyncio
+import sys
+import threading
+import time
+from collections import Counter
+
+# Один профиль за раз: параллельные запуски только искажают друг друга
+_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{code.co_name}:{frame.f_lineno}"
+
+
+def sample(duration: float, interval: float = 0.005) -> str:
+    """Снимает стеки каждые interval секунд в течение duration. Блокирует поток, запускать через to_thread"""
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        own_id = threading.get_ident()
+        names = {}
+        stacks: Counter = Counter()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+    finally:
+        _lock.release()
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+async def profile(duration: float, interval: float = 0.005) -> str:
+    """Профиль работающего процесса; event loop продолжает работать, пока идет сэмплирование"""
+    return await asyncio.to_thread(sample, duration, interval)
@@ -0,0 +1,194 @@
+"""
+Серверный кэш контекста Gemini: длинная системная инструкция и стабильный префикс истории
+"""
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from config import (
+    CONTEXT_CACHE_ENABLED, CONTEXT_CACHE_MIN_TOKENS, CONTEXT_CACHE_TTL, CONTEXT_CACHE_MAX_ENTRIES
+)
+from logger_config import get_logger
+
+logger = get_logger()
+
+# Сколько последних сообщений истории всегда уходит в запрос как есть
+HISTORY_WINDOW = 10
+
+
+class GenaiCacheBackend:
+    """Вызовы cachedContents API через google.generativeai (синхронные, выполняются в потоке)"""
+
+    def create(self, model: str, system_instruction: Optional[str], contents: List[dict], ttl: int) -> Any:
+        from google.generativeai import caching
+        return caching.CachedContent.create(
+            model=model,
+            display_name="sary-bala-context",
+            system_instruction=system_instruction,
+            contents=contents or None,
+            ttl=ttl,
+        )
+
+    def extend(self, handle: Any, ttl: int):
+        handle.update(ttl=ttl)
+
+    def delete(self, handle: Any):
+        handle.delete()
+
+    def model_for(self, handle: Any):
+        import google.generativeai as genai
+        return genai.GenerativeModel.from_cached_content(cached_content=handle)
+
+
+class CachedPrefix:
+    def __init__(self, fingerprint: str, base: str, handle: Any, expires_at: float, boundary: List[dict]):
+        self.fingerprint = fingerprint
+        # Модель и инструкция: при их смене префикс пересоздается
+        self.base = base
+        self.handle = handle
+        self.expires_at = expires_at
+        # Последние сообщения префикса: по ним в следующих ходах находится начало хвоста истории
+        self.boundary = boundary
+
+
+class ContextCache:
+    """
+    Один закэшированный префикс на пользователя: system_instruction плюс история старше
+    последних window сообщений.
+
+    Префикс стабилен, пока он виден в окне истории из history_limit сообщений: в запрос
+    уходят только сообщения после него. Когда префикс уходит из окна, создается новый из более
+    свежих сообщений. Кэш создается, только когда префикс длиннее min_tokens. Активным
+    пользователям TTL продлевается; при смене модели, инструкции или истории старый кэш удаляется.
+    """
+
+    def __init__(self, backend=None, min_tokens: int = CONTEXT_CACHE_MIN_TOKENS,
+                 ttl: int = CONTEXT_CACHE_TTL, max_entries: int = CONTEXT_CACHE_MAX_ENTRIES,
+                 enabled: bool = CONTEXT_CACHE_ENABLED, window: int = HISTORY_WINDOW):
+        self.backend = backend or GenaiCacheBackend()
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+        # Кэш, которому осталось жить меньше margin, уже не используется
+        self.margin = min(30.0, ttl / 4)
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.window = window
+        self._entries: "OrderedDict[int, CachedPrefix]" = OrderedDict()
+        # Создания, которые идут сейчас: параллельные запросы с тем же префиксом ждут одно и то же
+        self._creating: Dict[str, asyncio.Future] = {}
+        # Префиксы, которые API отказался кэшировать (модель без поддержки, мало токенов) -> до какого времени не пробовать
+        self._rejected: Dict[str, float] = {}
+
+    @property
+    def history_limit(self) -> int:
+        """Сколько последних сообщений истории передавать в get()"""
+        return self.window * 2 if self.enabled else self.window
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        # Грубая оценка без запроса count_tokens; для кириллицы ~3 символа на токен
+        return len(text) // 3
+
+    @staticmethod
+    def fingerprint(*parts: Any) -> str:
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False, default=str).encode()).hexdigest()
+
+    async def get(self, user_id: int, model: str, system_instruction: Optional[str],
+                  history: List[dict]) -> Tuple[Optional[Any], List[dict]]:
+        """
+        history — последние сообщения в формате chat history Gemini, по возрастанию.
+        Возвращает (handle кэша или None, история, которую нужно отправить в запросе)
+        """
+        tail = history[-self.window:]
+        if not self.enabled:
+            return None, tail
+
+        base = self.fingerprint(model, system_instruction)
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry and entry.base == base and entry.expires_at > now + self.margin:
+            after = self._after_prefix(history, entry.boundary)
+            if after is not None:
+                self._entries.move_to_end(user_id)
+                if entry.expires_at - now < self.ttl / 2:
+                    await self._extend(user_id, entry)
+                if self._entries.get(user_id) is entry:
+                    return entry.handle, after
+                return None, tail
+        if entry:
+            self._drop(user_id)
+
+        prefix = history[:-self.window]
+        text = (system_instruction or "") + "".join(str(p) for m in prefix for p in m["parts"])
+        if self.estimate_tokens(text) < self.min_tokens:
+            return None, tail
+        fp = self.fingerprint(user_id, model, system_instruction, prefix)
+        if self._rejected.get(fp, 0) > now:
+            return None, tail
+
+        try:
+            handle = await self._create(fp, model, system_instruction, prefix)
+        except Exception as e:
+            logger.warning(f"Context cache create failed for user {user_id} ({model}): {e}")
+            now = time.monotonic()
+            self._rejected = {k: until for k, until in self._rejected.items() if until > now}
+            self._rejected[fp] = now + 600
+            return None, tail
+
+        current = self._entries.get(user_id)
+        if current is not None and current.fingerprint != fp:
+            self._drop(user_id)
+        if user_id not in self._entries:
+            self._entries[user_id] = CachedPrefix(fp, base, handle, time.monotonic() + self.ttl, prefix[-2:])
+            logger.info(f"Context cache created for user {user_id} ({model}, {len(prefix)} history messages)")
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+        return handle, tail
+
+    def _after_prefix(self, history: List[dict], boundary: List[dict]) -> Optional[List[dict]]:
+        """Сообщения после закэшированного префикса или None, если префикс ушел из окна"""
+        if not boundary:
+            # В кэше только инструкция: годится, пока старой истории, которую стоит перенести, нет
+            return history if len(history) <= self.window else None
+        n = len(boundary)
+        for i in range(len(history) - n + 1):
+            if history[i:i + n] == boundary:
+                return history[i + n:]
+        return None
+
+    async def _create(self, fp: str, model: str, system_instruction: Optional[str], prefix: List[dict]) -> Any:
+        pending = self._creating.get(fp)
+        if pending is None:
+            pending = asyncio.ensure_future(
+                asyncio.to_thread(self.backend.create, model, system_instruction, prefix, self.ttl)
+            )
+            self._creating[fp] = pending
+            pending.add_done_callback(lambda _: self._creating.pop(fp, None))
+        return await asyncio.shield(pending)
+
+    async def _extend(self, user_id: int, entry: CachedPrefix):
+        try:
+            await asyncio.to_thread(self.backend.extend, entry.handle, self.ttl)
+            entry.expires_at = time.monotonic() + self.ttl
+        except Exception as e:
+            logger.warning(f"Context cache extend failed for user {user_id}: {e}")
+            if self._entries.get(user_id) is entry:
+                del self._entries[user_id]
+
+    def invalidate(self, user_id: int):
+        """Вызывается при изменении настроек пользователя"""
+        if user_id in self._entries:
+            self._drop(user_id)
+
+    def _drop(self, user_id: int):
+        entry = self._entries.pop(user_id)
+        # Удаление на сервере не должно задерживать ответ пользователю
+        asyncio.get_running_loop().run_in_executor(None, self._delete_quietly, entry.handle)
+
+    def _delete_quietly(self, handle: Any):
+        try:
+            self.backend.delete(handle)
+        except Exception as e:
+            logger.warning(f"Context cache delete failed: {e}")
@@ -1,34 +1,49 @@
 import os
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
-import PIL.Image
 from dotenv import load_dotenv
 from database import get_user_settings, get_chat_history, save_message, update_user_setting
 from logger_config import get_logger
 from services.tools_service import tools_service
+from services.context_cache import ContextCache, HISTORY_WINDOW
+from services.response_cache import ResponseCache
+from services.usage_service import UsageRecorder, usage_recorder, DOWNGRADE, DEFER
+from config import HISTORY_SEARCH_TOOL
+from metrics import GENERATION_TTFT, GENERATION_DURATION, RATE_LIMIT_REJECTIONS
+import tracing
 import datetime
 import asyncio
+import time
 
 load_dotenv()
 logger = get_logger()
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Сколько раз подряд модель может вызвать инструменты в одном ходе
+MAX_TOOL_ROUNDS = 5
 
 class GeminiService:
-    def __init__(self):
+    def __init__(self, context_cache: ContextCache = None, response_cache: ResponseCache = None, genai=None,
+                 usage: UsageRecorder = None):
         if not GEMINI_API_KEY:
             logger.critical("GEMINI_API_KEY not found!")
             raise ValueError("GEMINI_API_KEY not found")
         
+        if genai is None:
+            # SDK тяжелый: импортируем только при создании сервиса, а не при импорте модуля.
+            # Бенчмарк подставляет сюда фейковый клиент с тем же интерфейсом
+            import google.generativeai as genai
+        self.genai = genai
         genai.configure(api_key=GEMINI_API_KEY)
         
+        self.context_cache = context_cache or ContextCache()
+        self.response_cache = response_cache or ResponseCache()
+        self.usage = usage or usage_recorder
         self.available_models = []
         self._refresh_models()
 
     def _refresh_models(self):
         try:
             models = []
-            for m in genai.list_models():
+            for m in self.genai.list_models():
                 if 'generateContent' in m.supported_generation_methods:
                     name = m.name.replace('models/', '')
                     models.append(name)
@@ -38,7 +53,9 @@ class GeminiService:
             logger.warning(f'Could not fetch models from API: {e}')
             self.available_models = ["gemini-1.5-flash", "gemini-1.5-pro", "gemini-1.0-pro"]
 
-    async def generate_response_stream(self, user_id: int, prompt: str, images: list = None, audio_path: str = None):
+    async def generate_response_stream(self, user_id: int, prompt: str, images: list = None, audio=None):
+        genai = self.genai
+        started = time.perf_counter()
         settings = await get_user_settings(user_id)
         model_name = settings.get("selected_model", "gemini-1.5-flash-latest")
         
@@ -48,7 +65,20 @@ class GeminiService:
             model_name = fallback
             await update_user_setting(user_id, "selected_model", model_name)
 
-        logger.info(f"Stream generation for {user_id} using {model_name}.")
+        # Дневной бюджет токенов: сверх мягкого — модель попроще (настройка не меняется), сверх жесткого — отказ
+        admission = await self.usage.admit(user_id)
+        if admission == DEFER:
+            logger.info(f"Generation deferred for {user_id}: daily token budget exhausted",
+                        extra={"user_id": user_id, "model": model_name})
+            yield "⏳ Дневной лимит на сегодня исчерпан. Попробуйте снова после 00:00 UTC."
+            return
+        if admission == DOWNGRADE and model_name != self.usage.downgrade_model:
+            logger.info(f"Model downgraded for {user_id}: {model_name} -> {self.usage.downgrade_model}",
+                        extra={"user_id": user_id, "model": model_name})
+            model_name = self.usage.downgrade_model
+
+        log_fields = {"user_id": user_id, "model": model_name}
+        logger.info(f"Stream generation for {user_id} using {model_name}.", extra=log_fields)
 
         generation_config = {
             "temperature": settings.get("temperature", 0.7),
@@ -56,40 +86,78 @@ class GeminiService:
         }
 
         active_tools_names = ["search", "calculator", "weather"] if settings.get("use_tools") else []
-        tools = tools_service.get_tools_for_gemini(active_tools_names)
+        if active_tools_names and HISTORY_SEARCH_TOOL:
+            active_tools_names.append("history")
+        tools = tools_service.get_tools_for_gemini(active_tools_names, user_id=user_id)
         
         streaming_enabled = settings.get("stream_response", True)
         if tools:
             streaming_enabled = False
 
+        full_response = ""
+        usage = None
+        turn_saved = False
+        generate_span = None
         try:
-            model = genai.GenerativeModel(
-                model_name=model_name,
-                system_instruction=settings.get("system_instruction"),
-                tools=tools
-            )
-
-            db_history = await get_chat_history(user_id, limit=10)
+            # С кэшем контекста читается окно побольше: старая часть уходит в закэшированный префикс
+            history_limit = HISTORY_WINDOW if tools else self.context_cache.history_limit
+            db_history = await get_chat_history(user_id, limit=history_limit)
             chat_history = []
             for msg in db_history:
                 if not msg["content"]: continue
                 role = "user" if msg["role"] == "user" else "model"
                 chat_history.append({"role": role, "parts": [msg["content"]]})
 
+            if audio and not prompt: prompt = "Аудио сообщение"
+
+            # Детерминированный запрос мог уже встречаться: отдаем сохраненный ответ тем же стримом
+            cache_key = None
+            if self.response_cache.is_cacheable(generation_config["temperature"], tools, audio):
+                media = [img["data"] for img in images or []] + ([audio.data] if audio else [])
+                cache_key = self.response_cache.make_key(
+                    model_name, settings.get("system_instruction"), generation_config["temperature"],
+                    [] if media else chat_history, prompt, media
+                )
+                cached_response = await self.response_cache.get(cache_key)
+                if cached_response is not None:
+                    logger.info(f"Response cache hit for {user_id}", extra=log_fields)
+                    async for full_response in self.response_cache.replay(cached_response):
+                        yield full_response
+                    turn_saved = True
+                    await asyncio.shield(self._save_turn(user_id, prompt, full_response))
+                    return
+
+            # С кэшем контекста инструкция и старая история уже лежат на сервере; tools в кэш не входят
+            cached = None
+            if not tools:
+                cached, chat_history = await self.context_cache.get(
+                    user_id, model_name, settings.get("system_instruction"), chat_history
+                )
+            if cached is not None:
+                model = self.context_cache.backend.model_for(cached)
+            else:
+                model = genai.GenerativeModel(
+                    model_name=model_name,
+                    system_instruction=settings.get("system_instruction"),
+                    tools=tools
+                )
+
+            generate_span = tracing.begin("gemini.generate", model=model_name, streaming=streaming_enabled)
             content_parts = []
-            if audio_path: 
-                audio_file = genai.upload_file(path=audio_path)
-                while audio_file.state.name == "PROCESSING":
-                    await asyncio.sleep(1)
-                    audio_file = genai.get_file(audio_file.name)
-                content_parts.append(audio_file)
-                if not prompt: prompt = "Аудио сообщение"
+            if audio:
+                if audio.in_memory:
+                    # Небольшое аудио уходит прямо в запрос, без загрузки через File API
+                    content_parts.append({"mime_type": audio.mime_type, "data": audio.data})
+                else:
+                    audio_file = await asyncio.to_thread(genai.upload_file, path=audio.path, mime_type=audio.mime_type)
+                    while audio_file.state.name == "PROCESSING":
+                        await asyncio.sleep(1)
+                        audio_file = await asyncio.to_thread(genai.get_file, audio_file.name)
+                    content_parts.append(audio_file)
             
             if images:
                 content_parts.extend(images)
 
-            full_response = ""
-            
             if streaming_enabled:
                 if content_parts:
                     content_parts.append(prompt)
@@ -107,7 +175,11 @@ class GeminiService:
                     )
                 
                 async for chunk in response_iterator:
+                    # Итоговые счетчики токенов приходят с последним чанком
+                    usage = getattr(chunk, "usage_metadata", None) or usage
                     if chunk.text:
+                        if not full_response:
+                            GENERATION_TTFT.observe(time.perf_counter() - started, model=model_name)
                         full_response += chunk.text
                         yield full_response
                 
@@ -119,20 +191,95 @@ class GeminiService:
                         generation_config=generation_config
                     )
                 else:
-                    chat = model.start_chat(history=chat_history, enable_automatic_function_calling=True)
-                    response = await chat.send_message_async(
-                        prompt,
-                        generation_config=generation_config
-                    )
+                    chat = model.start_chat(history=chat_history)
+                    response = await self._send_with_tools(chat, prompt, generation_config, tools)
                 
                 full_response = response.text
+                usage = getattr(response, "usage_metadata", None)
+                # Без стрима первый токен приходит вместе со всем ответом
+                GENERATION_TTFT.observe(time.perf_counter() - started, model=model_name)
                 yield full_response
 
-            await save_message(user_id, "user", prompt)
-            await save_message(user_id, "model", full_response)
+            latency = time.perf_counter() - started
+            GENERATION_DURATION.observe(latency, model=model_name)
+            self.usage.record(user_id, model_name, usage, latency)
+            usage = None  # учтено: прерывание ниже не должно записать ход второй раз
+            logger.info(f"Generation finished for {user_id}", extra={
+                **log_fields, "latency_ms": round(latency * 1000, 1), "chars": len(full_response)
+            })
+            if generate_span:
+                generate_span.end(chars=len(full_response))
+            if cache_key and full_response:
+                await self.response_cache.put(cache_key, full_response)
+
+            turn_saved = True
+            await asyncio.shield(self._save_turn(user_id, prompt, full_response))
 
+        except (asyncio.CancelledError, GeneratorExit) as e:
+            if generate_span:
+                generate_span.end(error=e, chars=len(full_response))
+            self.usage.record(user_id, model_name, usage, time.perf_counter() - started)
+            # Генерация прервана остановкой бота: сохраняем ход с тем, что успели получить
+            if not turn_saved:
+                await asyncio.shield(self._save_turn(user_id, prompt, full_response))
+            raise
         except Exception as e:
-            logger.error(f"Stream Error: {e}")
+            if generate_span:
+                generate_span.end(error=e)
+            # 429 от Gemini: google.api_core.exceptions.ResourceExhausted
+            if getattr(e, "code", None) == 429 or type(e).__name__ == "ResourceExhausted":
+                RATE_LIMIT_REJECTIONS.inc(source="gemini")
+            logger.error(f"Stream Error: {e}", extra={
+                **log_fields, "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+                "error_type": type(e).__name__
+            })
             yield f"Ошибка API: {str(e)}"
 
-gemini_service = GeminiService()
+    async def _send_with_tools(self, chat, prompt, generation_config: dict, tools: list):
+        """
+        Вызов функций вместо автоматического в SDK: тот вызывает инструменты синхронно прямо
+        в event loop. Здесь async-инструменты ожидаются, а синхронные уходят в поток
+        """
+        functions = {f.__name__: f for f in tools}
+        response = await chat.send_message_async(prompt, generation_config=generation_config)
+        for _ in range(MAX_TOOL_ROUNDS):
+            parts = response.candidates[0].content.parts if response.candidates else []
+            calls = [p.function_call for p in parts if p.function_call.name]
+            if not calls:
+                break
+            results = []
+            for call in calls:
+                func = functions.get(call.name)
+                args = dict(call.args)
+                try:
+                    if func is None:
+                        result = f"Неизвестный инструмент: {call.name}"
+                    elif asyncio.iscoroutinefunction(func):
+                        result = await func(**args)
+                    else:
+                        result = await asyncio.to_thread(func, **args)
+                except Exception as e:
+                    result = f"Ошибка инструмента: {e}"
+                if not isinstance(result, dict):
+                    result = {"result": result}
+                results.append(self.genai.protos.Part(
+                    function_response=self.genai.protos.FunctionResponse(name=call.name, response=result)
+                ))
+            response = await chat.send_message_async(
+                self.genai.protos.Content(role="user", parts=results), generation_config=generation_config
+            )
+        return response
+
+    async def _save_turn(self, user_id: int, prompt: str, response: str):
+        await save_message(user_id, "user", prompt)
+        if response:
+            await save_message(user_id, "model", response)
+
+_gemini_service = None
+
+def get_gemini_service() -> GeminiService:
+    """Синглтон сервиса. main.py создает его явно на этапе запуска"""
+    global _gemini_service
+    if _gemini_service is None:
+        _gemini_service = GeminiService()
+    return _gemini_service
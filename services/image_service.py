@@ -0,0 +1,122 @@
+"""
+Подготовка фото для Gemini в пуле потоков: уменьшение, перекодирование и кэш по file_unique_id
+"""
+import asyncio
+import io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Union
+from aiogram import Bot
+from aiogram.types import PhotoSize
+from config import IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY, IMAGE_CACHE_BYTES, IMAGE_WORKERS
+from services.media_service import download_media
+from logger_config import get_logger
+
+logger = get_logger()
+
+_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+
+def pick_photo_size(photos: List[PhotoSize], max_side: int = IMAGE_MAX_SIDE) -> PhotoSize:
+    """Самый маленький вариант фото, который не меньше max_side (иначе самый большой)"""
+    for photo in sorted(photos, key=lambda p: p.width * p.height):
+        if max(photo.width, photo.height) >= max_side:
+            return photo
+    return max(photos, key=lambda p: p.width * p.height)
+
+
+def process_image(source: Union[bytes, str], max_side: int = IMAGE_MAX_SIDE, quality: int = IMAGE_JPEG_QUALITY) -> bytes:
+    """Декодирует, уменьшает и перекодирует картинку в JPEG. Выполняется в пуле потоков"""
+    import PIL.Image
+
+    raw = source if isinstance(source, bytes) else None
+    with PIL.Image.open(io.BytesIO(raw) if raw is not None else source) as img:
+        original_format = img.format
+        fits = max(img.size) <= max_side
+        # Для JPEG draft() декодирует сразу в уменьшенном масштабе, полный кадр не распаковывается
+        img.draft("RGB", (max_side, max_side))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.thumbnail((max_side, max_side))
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+
+    data = out.getvalue()
+    # Маленький JPEG после перекодирования может только вырасти
+    if raw is not None and fits and original_format == "JPEG" and len(raw) <= len(data):
+        return raw
+    return data
+
+
+class ImageCache:
+    """LRU готовых картинок, ограниченный суммарным размером в байтах"""
+
+    def __init__(self, max_bytes: int = IMAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        data = self._items.get(key)
+        if data is not None:
+            self._items.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        if key in self._items:
+            self.size -= len(self._items.pop(key))
+        self._items[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, old = self._items.popitem(last=False)
+            self.size -= len(old)
+
+
+image_cache = ImageCache()
+# Одинаковые пересланные фото, пришедшие одновременно, обрабатываются один раз
+_pending: Dict[str, asyncio.Future] = {}
+
+
+async def prepare_photo(bot: Bot, photos: List[PhotoSize]) -> Dict[str, Union[str, bytes]]:
+    """Возвращает blob для Gemini: {"mime_type": "image/jpeg", "data": ...}"""
+    photo = pick_photo_size(photos)
+    key = photo.file_unique_id
+
+    data = image_cache.get(key)
+    if data is None:
+        if key in _pending:
+            data = await asyncio.shield(_pending[key])
+        else:
+            future = asyncio.get_running_loop().create_future()
+            _pending[key] = future
+            try:
+                data = await _download_and_process(bot, photo)
+                image_cache.put(key, data)
+                future.set_result(data)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                # Помечаем ошибку полученной: ее получат ждущие, если они есть
+                future.exception()
+                raise
+            finally:
+                _pending.pop(key, None)
+
+    return {"mime_type": "image/jpeg", "data": data}
+
+
+async def _download_and_process(bot: Bot, photo: PhotoSize) -> bytes:
+    media = await download_media(bot, photo.file_id, "image/jpeg", photo.file_size)
+    try:
+        source = media.data if media.in_memory else media.path
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(_executor, process_image, source)
+    finally:
+        media.cleanup()
+    logger.info(f"Image {photo.file_unique_id}: {photo.width}x{photo.height}, "
+                f"{photo.file_size or 0} -> {len(data)} bytes")
+    return data
@@ -0,0 +1,109 @@
+"""
+Загрузка медиа из Telegram: в память, а крупные файлы — во временную папку (tmpfs, если есть)
+"""
+import asyncio
+import io
+import os
+import time
+import uuid
+from typing import Iterable, Optional
+from aiogram import Bot
+from config import MEDIA_TEMP_DIR, MEDIA_SPILL_THRESHOLD, TEMP_FILE_MAX_AGE, EXPORT_TEMP_DIR
+from logger_config import get_logger
+
+logger = get_logger()
+
+
+class MediaFile:
+    """Скачанный файл: либо байты в памяти, либо путь во временной папке"""
+
+    def __init__(self, mime_type: str, data: Optional[bytes] = None, path: Optional[str] = None):
+        self.mime_type = mime_type
+        self.data = data
+        self.path = path
+
+    @property
+    def in_memory(self) -> bool:
+        return self.data is not None
+
+    def open(self):
+        """Файловый объект для чтения (например, для PIL)"""
+        return io.BytesIO(self.data) if self.in_memory else open(self.path, "rb")
+
+    def cleanup(self):
+        if self.path:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+async def download_media(bot: Bot, file_id: str, mime_type: str, file_size: Optional[int] = None) -> MediaFile:
+    """Скачивает файл из Telegram; на диск попадают только файлы больше MEDIA_SPILL_THRESHOLD"""
+    file = await bot.get_file(file_id)
+    size = file_size or file.file_size or 0
+
+    if size <= MEDIA_SPILL_THRESHOLD:
+        buffer = io.BytesIO()
+        await bot.download_file(file.file_path, destination=buffer)
+        return MediaFile(mime_type, data=buffer.getvalue())
+
+    ext = file.file_path.rsplit(".", 1)[-1] if "." in file.file_path else "bin"
+    # Один и тот же файл могут качать параллельно (пересылки, альбомы, повтор): у каждой загрузки свой путь
+    path = os.path.join(MEDIA_TEMP_DIR, f"{file.file_unique_id}-{uuid.uuid4().hex}.{ext}")
+    os.makedirs(MEDIA_TEMP_DIR, exist_ok=True)
+    # aiogram пишет файл на диск асинхронно, event loop не блокируется
+    await bot.download_file(file.file_path, destination=path)
+    logger.info(f"Media {file.file_unique_id} ({size} bytes) spilled to {path}")
+    return MediaFile(mime_type, path=path)
+
+
+class TempJanitor:
+    """Фоновая уборка забытых временных файлов по возрасту: медиа и файлы /export"""
+
+    def __init__(self, temp_dirs: Iterable[str] = (MEDIA_TEMP_DIR, EXPORT_TEMP_DIR),
+                 max_age: float = TEMP_FILE_MAX_AGE, interval: float = 600.0):
+        # Без повторов: обе папки по умолчанию могут совпадать
+        self.temp_dirs = list(dict.fromkeys(temp_dirs))
+        self.max_age = max_age
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            for temp_dir in self.temp_dirs:
+                try:
+                    removed = await asyncio.to_thread(self.sweep, temp_dir)
+                    if removed:
+                        logger.info(f"Temp janitor removed {removed} stale files from {temp_dir}")
+                except Exception as e:
+                    logger.error(f"Temp janitor error in {temp_dir}: {e}")
+            await asyncio.sleep(self.interval)
+
+    def sweep(self, temp_dir: str) -> int:
+        """Удаляет файлы старше max_age из temp_dir. Выполняется в отдельном потоке"""
+        os.makedirs(temp_dir, exist_ok=True)
+        cutoff = time.time() - self.max_age
+        removed = 0
+        with os.scandir(temp_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        return removed
+
+
+temp_janitor = TempJanitor()
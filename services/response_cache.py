@@ -0,0 +1,89 @@
+"""
+Кэш ответов для детерминированных запросов (низкая температура, без инструментов)
+"""
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import List, Optional
+from config import (
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_MAX_TEMPERATURE, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
+)
+from database import db as default_db
+from logger_config import get_logger
+
+logger = get_logger()
+
+
+class ResponseCache:
+    """Точное совпадение запроса: LRU в памяти процесса + постоянный слой в БД"""
+
+    # Кусок текста, которым ответ из кэша "печатается" в Telegram
+    REPLAY_CHUNK = 200
+
+    def __init__(self, database=default_db, enabled: bool = RESPONSE_CACHE_ENABLED,
+                 max_temperature: float = RESPONSE_CACHE_MAX_TEMPERATURE,
+                 max_entries: int = RESPONSE_CACHE_SIZE, ttl: int = RESPONSE_CACHE_TTL):
+        self.db = database
+        self.enabled = enabled
+        self.max_temperature = max_temperature
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._puts = 0
+
+    def is_cacheable(self, temperature: float, tools: list, audio=None) -> bool:
+        if not self.enabled or tools or temperature > self.max_temperature:
+            return False
+        # Крупное аудио лежит на диске и не хэшируется
+        return audio is None or audio.in_memory
+
+    @staticmethod
+    def make_key(model: str, system_instruction: Optional[str], temperature: float,
+                 history: List[dict], prompt: str, media: List[bytes]) -> str:
+        payload = json.dumps(
+            [model, system_instruction or "", temperature, history, prompt,
+             [hashlib.sha256(m).hexdigest() for m in media]],
+            ensure_ascii=False, sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        item = self._memory.get(key)
+        if item and item[0] >= now - self.ttl:
+            self._memory.move_to_end(key)
+            return item[1]
+        try:
+            response = await self.db.get_cached_response(key, now - self.ttl)
+        except Exception as e:
+            logger.warning(f"Response cache read failed: {e}")
+            return None
+        if response is not None:
+            self._remember(key, response, now)
+        return response
+
+    async def put(self, key: str, response: str):
+        now = time.time()
+        self._remember(key, response, now)
+        try:
+            await self.db.put_cached_response(key, response, now)
+            self._puts += 1
+            if self._puts % 500 == 0:
+                await self.db.prune_response_cache(now - self.ttl)
+        except Exception as e:
+            logger.warning(f"Response cache write failed: {e}")
+
+    def _remember(self, key: str, response: str, created_at: float):
+        self._memory[key] = (created_at, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    async def replay(self, response: str):
+        """Отдает ответ из кэша нарастающими кусками, как обычный стрим"""
+        for end in range(self.REPLAY_CHUNK, len(response), self.REPLAY_CHUNK):
+            yield response[:end]
+            await asyncio.sleep(0)
+        yield response
@@ -0,0 +1,185 @@
+"""
+Хранение истории: фоновая чистка message_history по возрасту и по числу сообщений на пользователя
+"""
+import asyncio
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, List, Optional
+from config import (
+    HISTORY_RETENTION_DAYS, HISTORY_MAX_MESSAGES, RETENTION_INTERVAL,
+    RETENTION_BATCH_SIZE, RETENTION_BATCH_PAUSE, HISTORY_ARCHIVE_DIR, HISTORY_PARTITIONING,
+    HISTORY_CACHE_DEPTH, USAGE_RETENTION_DAYS
+)
+from database import db as default_db
+from logger_config import get_logger
+
+logger = get_logger()
+
+
+class HistoryArchive:
+    """Удаляемые сообщения дописываются в jsonl.gz (один файл на день) до удаления из БД"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def write(self, rows: List[dict]):
+        """Выполняется в отдельном потоке; каждая пачка — отдельный gzip-член файла"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"history-{datetime.utcnow():%Y%m%d}.jsonl.gz")
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+
+
+class RetentionJob:
+    """
+    Периодический проход: на Postgres с секциями — удаление целых месяцев, затем построчно
+    пачками по RETENTION_BATCH_SIZE с паузой, чтобы не держать блокировку и не мешать записи.
+    """
+
+    def __init__(self, database=default_db, max_age_days: int = HISTORY_RETENTION_DAYS,
+                 max_messages: int = HISTORY_MAX_MESSAGES, interval: float = RETENTION_INTERVAL,
+                 batch_size: int = RETENTION_BATCH_SIZE, pause: float = RETENTION_BATCH_PAUSE,
+                 archive_dir: str = HISTORY_ARCHIVE_DIR, partitioning: bool = HISTORY_PARTITIONING,
+                 usage_max_age_days: int = USAGE_RETENTION_DAYS):
+        self.db = database
+        self.max_age_days = max_age_days
+        if 0 < max_messages < HISTORY_CACHE_DEPTH:
+            logger.warning(f"HISTORY_MAX_MESSAGES={max_messages} is below the history cache depth, "
+                           f"using {HISTORY_CACHE_DEPTH}")
+            max_messages = HISTORY_CACHE_DEPTH
+        self.max_messages = max_messages
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.archive = HistoryArchive(archive_dir) if archive_dir else None
+        self.partitioning = partitioning
+        self.usage_max_age_days = usage_max_age_days
+        # Кто еще держит кэш истории (воркеры в многопроцессном режиме): получают user_id или None — все
+        self.listeners: List[Callable[[Optional[Iterable[int]]], None]] = []
+        # До какого id сообщений лимит уже проверен: следующий проход смотрит только тех, кто писал после
+        self._checked_id = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        # С секционированием задача нужна и без лимитов: без секции на текущий месяц вставка упадет
+        return self.max_age_days > 0 or self.max_messages > 0 or self.partitioning or self.usage_max_age_days > 0
+
+    async def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Retention error: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> int:
+        started = time.perf_counter()
+        await self.db.ensure_history_partitions()
+        removed = 0
+        if self.max_age_days > 0:
+            cutoff = datetime.utcnow() - timedelta(days=self.max_age_days)
+            removed += await self._drop_partitions(cutoff)
+            while True:
+                rows = await self.db.get_expired_history(cutoff, self.batch_size)
+                removed += await self._remove(rows)
+                if len(rows) < self.batch_size:
+                    break
+        if self.max_messages > 0:
+            removed += await self._trim_users()
+        if removed:
+            logger.info(f"Retention removed {removed} messages",
+                        extra={"latency_ms": round((time.perf_counter() - started) * 1000, 1)})
+        if self.usage_max_age_days > 0:
+            await self._prune_token_usage(time.time() - self.usage_max_age_days * 86400)
+        return removed
+
+    async def _trim_users(self, limit: int = 1000) -> int:
+        """Лишние сообщения сверх max_messages у пользователей, писавших после прошлого прохода"""
+        removed = 0
+        checked_id = await self.db.max_history_id()
+        while True:
+            users = await self.db.get_users_over_history_limit(self.max_messages, self._checked_id, limit)
+            for user_id in users:
+                while True:
+                    rows = await self.db.get_excess_history(user_id, self.max_messages, self.batch_size)
+                    removed += await self._remove(rows)
+                    if len(rows) < self.batch_size:
+                        break
+            # Обработанные пользователи больше не попадают в выборку: следующая пачка — остальные
+            if len(users) < limit:
+                break
+        self._checked_id = checked_id
+        return removed
+
+    async def _prune_token_usage(self, older_than: float):
+        """Сырые записи учета токенов; token_usage_daily не трогаем"""
+        pruned = 0
+        while True:
+            deleted = await self.db.delete_expired_token_usage(older_than, self.batch_size)
+            pruned += deleted
+            if deleted < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+        if pruned:
+            logger.info(f"Retention removed {pruned} token usage records")
+
+    async def _remove(self, rows: List[dict]) -> int:
+        if not rows:
+            return 0
+        if self.archive:
+            await asyncio.to_thread(self.archive.write, rows)
+        await self.db.delete_history_by_ids([r["id"] for r in rows])
+        self._invalidate({r["user_id"] for r in rows})
+        await asyncio.sleep(self.pause)
+        return len(rows)
+
+    async def _drop_partitions(self, cutoff: datetime) -> int:
+        """Месячные секции целиком старше cutoff (только Postgres с HISTORY_PARTITIONING)"""
+        removed, dropped = 0, False
+        for name, _, end in await self.db.list_history_partitions():
+            if end > cutoff:
+                break
+            if self.archive:
+                after_id = 0
+                while True:
+                    rows = await self.db.read_partition_batch(name, after_id, self.batch_size)
+                    if not rows:
+                        break
+                    await asyncio.to_thread(self.archive.write, rows)
+                    removed += len(rows)
+                    after_id = rows[-1]["id"]
+            await self.db.drop_history_partition(name)
+            dropped = True
+            logger.info(f"Retention dropped partition {name}")
+        if dropped:
+            self._invalidate(None)
+        return removed
+
+    def _invalidate(self, user_ids: Optional[set]):
+        """Кэши хвоста истории могли содержать удаленные сообщения"""
+        cache = self.db.history_cache
+        if cache is not None:
+            if user_ids is None:
+                cache.clear()
+            else:
+                for user_id in user_ids:
+                    cache.drop(user_id)
+        for listener in self.listeners:
+            listener(user_ids)
+
+
+retention_job = RetentionJob()
@@ -1,32 +1,36 @@
-import numexpr
-from duckduckgo_search import DDGS
-import httpx
 import os
 import json
+from metrics import observe_tool
 
 # --- Инструменты ---
 
+@observe_tool
 def search_internet(query: str):
     """Ищет информацию в интернете (DuckDuckGo)."""
+    from duckduckgo_search import DDGS
     try:
         results = DDGS().text(query, max_results=3)
         return "\n\n".join([f"{r.get('title', '')}: {r.get('body', '')}" for r in results]) if results else "Ничего не найдено."
     except Exception as e:
         return f"Ошибка поиска: {e}"
 
+@observe_tool
 def calculator(expression: str):
     """Вычисляет математическое выражение."""
+    import numexpr
     try:
         return str(numexpr.evaluate(expression))
     except Exception as e:
         return f"Ошибка вычисления: {e}"
 
+@observe_tool
 def get_weather(city: str):
     """Возвращает погоду."""
     return f"Погода в {city}: 22°C, солнечно (демо)."
 
 def _call_rube_tool(tool_name: str, args: dict):
     """Internal helper to call Rube tools via MCP (supports SSE)."""
+    import httpx
     api_key = os.getenv("RUBE_API_KEY")
     url = os.getenv("RUBE_API_URL")
     
@@ -78,11 +82,13 @@ def _call_rube_tool(tool_name: str, args: dict):
     except Exception as e:
         return f"Connection error: {e}"
 
+@observe_tool
 def check_rube_connections(apps: str = "gmail, github, slack, notion"):
     """Проверяет статус подключений к приложениям через Rube."""
     app_list = [a.strip().lower() for a in apps.split(",")]
     return _call_rube_tool("RUBE_MANAGE_CONNECTIONS", {"toolkits": app_list})
 
+@observe_tool
 def rube_action(task: str):
     """Ищет способы выполнения задач через Rube."""
     res = _call_rube_tool("RUBE_SEARCH_TOOLS", {
@@ -94,6 +100,22 @@ def rube_action(task: str):
         return str(res)[:3000] + "... (truncated)"
     return res
 
+def make_history_search_tool(user_id: int):
+    """Инструмент поиска по истории, привязанный к пользователю: модель не может искать в чужих диалогах"""
+    # async: GeminiService вызывает такие инструменты через await, запрос идет через общий пул БД
+    @observe_tool
+    async def search_history(query: str):
+        """Ищет в прошлых сообщениях этого диалога. Используй, когда пользователь ссылается на то, что обсуждалось раньше."""
+        from database import db
+        try:
+            rows = await db.search_history(user_id, query, 5, 0)
+        except Exception as e:
+            return f"Ошибка поиска по истории: {e}"
+        if not rows:
+            return "В истории ничего не найдено."
+        return "\n".join(f"[{str(r['timestamp'])[:16]}] {r['role']}: {r['snippet']}" for r in rows)
+    return search_history
+
 AVAILABLE_TOOLS = {
     "search": search_internet,
     "calculator": calculator,
@@ -103,10 +125,13 @@ AVAILABLE_TOOLS = {
 }
 
 class ToolsService:
-    def get_tools_for_gemini(self, active_tools: list):
+    def get_tools_for_gemini(self, active_tools: list, user_id: int = None):
         tools = []
         for name in active_tools:
-            if name == "rube":
+            if name == "history":
+                if user_id is not None:
+                    tools.append(make_history_search_tool(user_id))
+            elif name == "rube":
                 tools.append(AVAILABLE_TOOLS["check_connectors"])
                 tools.append(AVAILABLE_TOOLS["rube_action"])
             elif name in AVAILABLE_TOOLS:
@@ -0,0 +1,152 @@
+"""
+Учет токенов Gemini по пользователям и дневной бюджет перед генерацией
+"""
+import asyncio
+import time
+from typing import Dict, List, Optional
+from config import (
+    USAGE_BATCH_SIZE, USAGE_FLUSH_INTERVAL, USAGE_SOFT_BUDGET, USAGE_HARD_BUDGET, USAGE_DOWNGRADE_MODEL
+)
+from database import db as default_db
+from logger_config import get_logger
+from metrics import GENERATION_TOKENS, USAGE_ADMISSIONS
+
+logger = get_logger()
+
+ADMIT = "admit"
+DOWNGRADE = "downgrade"
+DEFER = "defer"
+
+
+def _today() -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+
+class UsageRecorder:
+    """
+    Записи копятся в памяти и уходят в БД одной транзакцией: по размеру пачки или по таймеру.
+    Дневные суммы пользователей держатся в памяти процесса (пользователь всегда попадает
+    в один воркер), из БД они читаются один раз в сутки на пользователя.
+    """
+
+    # Сколько записей держать, если БД недоступна
+    MAX_PENDING = 10000
+
+    def __init__(self, database=default_db, batch_size: int = USAGE_BATCH_SIZE,
+                 flush_interval: float = USAGE_FLUSH_INTERVAL, soft_budget: int = USAGE_SOFT_BUDGET,
+                 hard_budget: int = USAGE_HARD_BUDGET, downgrade_model: str = USAGE_DOWNGRADE_MODEL):
+        self.db = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.soft_budget = soft_budget
+        self.hard_budget = hard_budget
+        self.downgrade_model = downgrade_model
+        self._pending: List[tuple] = []
+        self._day = _today()
+        self._spent: Dict[int, int] = {}
+        # Идущие записи в БД и их пачки: остановка дожидается их, а не отменяет
+        self._writes: Dict[asyncio.Task, List[tuple]] = {}
+        # Запись пачки и чтение дневной суммы не пересекаются: иначе пачка, записанная во время чтения,
+        # учлась бы дважды (из БД и из памяти) или ни разу
+        self._io = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        if self._writes:
+            await asyncio.gather(*list(self._writes), return_exceptions=True)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def record(self, user_id: int, model: str, usage_metadata, latency: float):
+        """Учет одного хода; usage_metadata — из ответа Gemini (может отсутствовать)"""
+        if usage_metadata is None:
+            return
+        prompt = getattr(usage_metadata, "prompt_token_count", 0) or 0
+        output = getattr(usage_metadata, "candidates_token_count", 0) or 0
+        cached = getattr(usage_metadata, "cached_content_token_count", 0) or 0
+        GENERATION_TOKENS.inc(prompt, model=model, kind="prompt")
+        GENERATION_TOKENS.inc(output, model=model, kind="output")
+        if cached:
+            GENERATION_TOKENS.inc(cached, model=model, kind="cached")
+
+        self._rollover()
+        if user_id in self._spent:
+            self._spent[user_id] += prompt + output
+        self._pending.append((user_id, model, prompt, output, cached, round(latency * 1000, 1), time.time()))
+        if len(self._pending) >= self.batch_size and not self._writes:
+            self._start_write()
+
+    async def flush(self):
+        task = self._start_write()
+        if task is not None:
+            # Отмена того, кто ждет (например, цикла при stop()), не прерывает саму запись:
+            # пачка уже вынута из _pending и иначе потерялась бы
+            await asyncio.shield(task)
+
+    def _start_write(self) -> Optional[asyncio.Task]:
+        if not self._pending:
+            return None
+        records, self._pending = self._pending, []
+        task = asyncio.create_task(self._write(records))
+        self._writes[task] = records
+        task.add_done_callback(lambda t: self._writes.pop(t, None))
+        return task
+
+    async def _write(self, records: List[tuple]):
+        try:
+            async with self._io:
+                try:
+                    await self.db.record_token_usage(records)
+                finally:
+                    # До освобождения блокировки: пачка уже в БД или сейчас вернется в очередь
+                    self._writes.pop(asyncio.current_task(), None)
+        except Exception as e:
+            logger.error(f"Token usage flush failed: {e}")
+            # Вернем записи в очередь, но не дадим ей расти без предела
+            self._pending = (records + self._pending)[-self.MAX_PENDING:]
+
+    async def spent_today(self, user_id: int) -> int:
+        self._rollover()
+        if user_id not in self._spent:
+            day = self._day
+            async with self._io:
+                spent = await self.db.get_daily_tokens(user_id, day)
+                # Еще не записанные в БД ходы: в очереди и в пачках, ожидающих записи
+                unsaved = self._pending + [r for records in self._writes.values() for r in records]
+                spent += sum(r[2] + r[3] for r in unsaved if r[0] == user_id)
+            if day == self._day:
+                self._spent.setdefault(user_id, spent)
+        return self._spent.get(user_id, 0)
+
+    async def admit(self, user_id: int) -> str:
+        """ADMIT, DOWNGRADE (сверх мягкого бюджета) или DEFER (сверх жесткого)"""
+        if self.soft_budget <= 0 and self.hard_budget <= 0:
+            return ADMIT
+        spent = await self.spent_today(user_id)
+        if self.hard_budget > 0 and spent >= self.hard_budget:
+            USAGE_ADMISSIONS.inc(action=DEFER)
+            return DEFER
+        if self.soft_budget > 0 and spent >= self.soft_budget:
+            USAGE_ADMISSIONS.inc(action=DOWNGRADE)
+            return DOWNGRADE
+        return ADMIT
+
+    def _rollover(self):
+        day = _today()
+        if day != self._day:
+            self._day = day
+            self._spent.clear()
+
+
+usage_recorder = UsageRecorder()
@@ -0,0 +1,229 @@
+"""
+Многопроцессный режим: супервизор принимает апдейты и раздает их воркерам по user_id
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+import zlib
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional
+from aiogram import Bot, Dispatcher
+from config import SHUTDOWN_GRACE_PERIOD, METRICS_HOST, METRICS_PORT
+from database import close_db, db
+from lifecycle import StartupReport, drain_inflight, install_stop_handlers, listen_updates
+from logger_config import stop_logging
+from metrics import start_metrics_server
+
+logger = logging.getLogger(__name__)
+
+# Поля апдейта, в которых Telegram передает автора события
+_USER_FIELDS = ("from", "user", "voter_chat")
+# Служебное сообщение в очереди воркера: сбросить кэш истории (список user_id или None — весь кэш)
+INVALIDATE_HISTORY = "_invalidate_history"
+
+
+def extract_user_id(update: Dict[str, Any]) -> int:
+    """Достает id пользователя (или чата) из сырого апдейта"""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        for field in _USER_FIELDS:
+            user = event.get(field)
+            if isinstance(user, dict) and "id" in user:
+                return user["id"]
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return 0
+
+
+def shard_for(user_id: int, workers: int) -> int:
+    """Номер воркера для пользователя: стабилен между перезапусками"""
+    return zlib.crc32(str(user_id).encode()) % workers
+
+
+def worker_main(index: int, queue: multiprocessing.Queue):
+    """Точка входа процесса-воркера"""
+    # Ctrl+C получает вся группа процессов, а останавливает воркеров супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_worker_loop(index, queue))
+
+
+async def _worker_loop(index: int, queue: multiprocessing.Queue):
+    from main import startup
+
+    report = StartupReport()
+    bot, dp = await startup(report, log_name=f"worker-{index}", pinned_users=True)
+    report.log(f"Worker {index} startup")
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT and METRICS_PORT + 1 + index)
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    # Очередь апдейтов на пользователя: его апдейты обрабатываются строго по одному и по порядку,
+    # разные пользователи — параллельно. Запись удаляется, как только очередь пустеет
+    backlogs: Dict[int, Deque[Dict[str, Any]]] = {}
+    logger.info(f"Worker {index} started")
+
+    def invalidate_history(user_ids: Optional[List[int]]):
+        if db.history_cache is None:
+            return
+        if user_ids is None:
+            db.history_cache.clear()
+        else:
+            for user_id in user_ids:
+                db.history_cache.drop(user_id)
+
+    async def process(update: Dict[str, Any]):
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.error(f"Worker {index} failed to process update {update.get('update_id')}: {e}")
+
+    async def process_user(user_id: int, backlog: Deque[Dict[str, Any]]):
+        try:
+            while backlog:
+                await process(backlog[0])
+                backlog.popleft()
+        finally:
+            del backlogs[user_id]
+
+    def dispatch(update: Dict[str, Any]):
+        user_id = extract_user_id(update)
+        backlog = backlogs.get(user_id)
+        if backlog is not None:
+            backlog.append(update)
+            return
+        backlogs[user_id] = deque([update])
+        task = asyncio.create_task(process_user(user_id, backlogs[user_id]))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    await dp.emit_startup(bot=bot)
+    try:
+        while True:
+            update = await loop.run_in_executor(None, queue.get)
+            if update is None:
+                break
+            if INVALIDATE_HISTORY in update:
+                invalidate_history(update[INVALIDATE_HISTORY])
+                continue
+            dispatch(update)
+        await drain_inflight(SHUTDOWN_GRACE_PERIOD)
+        if tasks:
+            await asyncio.wait(tasks, timeout=5)
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        from services.usage_service import usage_recorder
+        await usage_recorder.flush()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await close_db()
+        await bot.session.close()
+        logger.info(f"Worker {index} stopped")
+        stop_logging()
+
+
+class WorkerPool:
+    """Пул процессов-воркеров, у каждого своя очередь апдейтов"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queues: List[multiprocessing.Queue] = [self._ctx.Queue() for _ in range(workers)]
+        self._procs: List[Optional[multiprocessing.Process]] = [None] * workers
+        self._watchdog: Optional[asyncio.Task] = None
+
+    def _spawn(self, index: int):
+        proc = self._ctx.Process(
+            target=worker_main, args=(index, self._queues[index]),
+            name=f"sary-bala-worker-{index}", daemon=True
+        )
+        proc.start()
+        self._procs[index] = proc
+
+    def start(self):
+        for i in range(self.workers):
+            self._spawn(i)
+        self._watchdog = asyncio.create_task(self._watch())
+        logger.info(f"Started {self.workers} workers")
+
+    def alive_count(self) -> int:
+        return sum(1 for p in self._procs if p is not None and p.is_alive())
+
+    async def _watch(self, interval: float = 5.0):
+        """
+        Перезапускает упавших воркеров. Очередь воркера сохраняется, поэтому апдейты, еще не взятые
+        из нее, обработает новый процесс. Апдейты, которые упавший воркер уже забрал и обрабатывал,
+        теряются: ответа на них пользователь не получит.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for i, proc in enumerate(self._procs):
+                if proc is not None and not proc.is_alive():
+                    logger.error(f"Worker {i} died with exit code {proc.exitcode}, restarting")
+                    self._spawn(i)
+
+    def route(self, update: Dict[str, Any]):
+        index = shard_for(extract_user_id(update), self.workers)
+        self._queues[index].put(update)
+
+    def invalidate_history(self, user_ids: Optional[Iterable[int]] = None):
+        """
+        Сброс кэша истории в воркерах после удаления сообщений в супервизоре. Идет через те же
+        очереди, что и апдейты, поэтому следующий апдейт пользователя уже читает историю из БД
+        """
+        if user_ids is None:
+            for q in self._queues:
+                q.put({INVALIDATE_HISTORY: None})
+            return
+        by_shard: Dict[int, List[int]] = {}
+        for user_id in user_ids:
+            by_shard.setdefault(shard_for(user_id, self.workers), []).append(user_id)
+        for index, ids in by_shard.items():
+            self._queues[index].put({INVALIDATE_HISTORY: ids})
+
+    async def stop(self, timeout: float = SHUTDOWN_GRACE_PERIOD + 15):
+        if self._watchdog:
+            self._watchdog.cancel()
+        for q in self._queues:
+            q.put(None)
+        for i, proc in enumerate(self._procs):
+            if proc is None:
+                continue
+            await asyncio.to_thread(proc.join, timeout)
+            if proc.is_alive():
+                logger.warning(f"Worker {i} did not stop in {timeout}s, terminating")
+                proc.terminate()
+        logger.info("All workers stopped")
+
+
+async def _poll_and_route(bot: Bot, dp: Dispatcher, pool: WorkerPool):
+    await bot.delete_webhook(drop_pending_updates=True)
+    # Апдейты не обрабатываются в супервизоре, а раздаются воркерам
+    async for update in listen_updates(bot, dp.resolve_used_update_types()):
+        pool.route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+
+
+async def run_sharded(bot: Bot, dp: Dispatcher, mode: str, workers: int):
+    """Супервизор: получает апдейты (polling/webhook) и раздает их N воркерам"""
+    from services.retention_service import retention_job
+
+    pool = WorkerPool(workers)
+    pool.start()
+    # Чистка истории идет в супервизоре, а кэши истории — в воркерах
+    retention_job.listeners.append(pool.invalidate_history)
+    try:
+        if mode == "webhook":
+            from webhook_server import run_webhook
+            await run_webhook(bot, dp, pool=pool)
+        else:
+            logger.info(f"Bot is running with {workers} workers! 🚀")
+            polling = asyncio.create_task(_poll_and_route(bot, dp, pool))
+            install_stop_handlers(polling.cancel)
+            try:
+                await polling
+            except asyncio.CancelledError:
+                logger.info("Polling stopped")
+    finally:
+        retention_job.listeners.remove(pool.invalidate_history)
+        await pool.stop()
@@ -0,0 +1,155 @@
+"""
+Трассировка апдейтов: корневой span на апдейт и дочерние span'ы для БД, Gemini, tools и Telegram.
+Готовая трасса пишется в лог одной JSON-записью
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+
+# Дочерний логгер: записи идут в те же обработчики, что и основной лог бота
+trace_logger = logging.getLogger("sary_bala_bot.trace")
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, trace: "Trace", name: str, parent: Optional["Span"], attrs: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = len(trace.spans) + 1
+        self.parent_id = parent.span_id if parent else None
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        trace.spans.append(self)
+
+    def end(self, error: Optional[BaseException] = None, **attrs: Any):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self.started
+        self.attrs.update(attrs)
+        if error is not None:
+            self.error = type(error).__name__
+
+    def to_dict(self) -> Dict[str, Any]:
+        record = {
+            "id": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start_ms": round((self.started - self.trace.started) * 1000, 2),
+            "duration_ms": round(self.duration * 1000, 2) if self.duration is not None else None,
+        }
+        if self.attrs:
+            record["attrs"] = self.attrs
+        if self.error:
+            record["error"] = self.error
+        return record
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = os.urandom(8).hex()
+        self.started = time.perf_counter()
+        self.spans: List[Span] = []
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def begin(name: str, **attrs: Any) -> Optional[Span]:
+    """
+    Span, который не становится текущим: для участков, которые переживают yield
+    (стрим Gemini), чтобы вызовы между чанками не попали к нему в дети
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    return Span(parent.trace, name, parent, attrs)
+
+
+@contextmanager
+def span(name: str, **attrs: Any):
+    """Дочерний span текущей трассы; вне трассы ничего не делает"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, parent, attrs)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.end(error=e)
+        raise
+    finally:
+        child.end()
+        _current_span.reset(token)
+
+
+def _export(trace: Trace, root: Span, min_duration_ms: float = 0.0):
+    if root.duration * 1000 < min_duration_ms:
+        return
+    duration_ms = round(root.duration * 1000, 2)
+    record = {
+        "trace_id": trace.trace_id,
+        "user_id": root.attrs.get("user_id"),
+        "latency_ms": duration_ms,
+        "attrs": root.attrs,
+        "spans": [s.to_dict() for s in trace.spans[1:]],
+    }
+    if root.error:
+        record["error_type"] = root.error
+    # Сама трасса уходит полями записи: JSON-форматтер логов пишет ее целиком
+    trace_logger.info(f"Trace {root.name} {root.attrs.get('type')} {duration_ms}ms", extra=record)
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Внешний middleware на dp.update: одна трасса на апдейт"""
+
+    def __init__(self, enabled: bool = True, min_duration_ms: float = 0.0):
+        self.enabled = enabled
+        self.min_duration_ms = min_duration_ms
+        super().__init__()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        if not self.enabled:
+            return await handler(event, data)
+
+        user = data.get("event_from_user")
+        trace = Trace()
+        root = Span(trace, "update", None, {
+            "update_id": event.update_id,
+            "type": event.event_type,
+            "user_id": user.id if user else None,
+        })
+        token = _current_span.set(root)
+        try:
+            return await handler(event, data)
+        except BaseException as e:
+            root.end(error=e)
+            raise
+        finally:
+            root.end()
+            _current_span.reset(token)
+            _export(trace, root, self.min_duration_ms)
+
+
+class TelegramTracingMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: каждый вызов Bot API становится span'ом telegram.<метод>"""
+
+    async def __call__(self, make_request, bot, method):
+        with span(f"telegram.{method.__api_method__}"):
+            return await make_request(bot, method)
@@ -0,0 +1,169 @@
+"""
+Webhook-режим: прием апдейтов через aiohttp вместо long polling
+"""
+import asyncio
+import hashlib
+import hmac
+import logging
+from typing import TYPE_CHECKING, Any, Dict, Optional, Set
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from config import (
+    BOT_TOKEN, WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_DROP_PENDING_UPDATES,
+    WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_MAX_CONCURRENCY, SHUTDOWN_GRACE_PERIOD,
+)
+from lifecycle import drain_inflight, install_stop_handlers
+
+if TYPE_CHECKING:
+    from sharding import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука с ограничением числа одновременно обрабатываемых апдейтов.
+    Переопределен только публичный handle(): апдейт обрабатывается в своей задаче через
+    dispatcher.feed_raw_update, без внутренних методов фоновой обработки aiogram
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrency: int = 32, **kwargs: Any):
+        """
+        Args:
+            max_concurrency: Максимум апдейтов в обработке одновременно.
+                Когда лимит исчерпан, ответ Telegram задерживается до освобождения слота,
+                и Telegram сам притормаживает доставку.
+        """
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **kwargs)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: Set[asyncio.Task] = set()
+        self.accepting = True
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.accepting:
+            # Идет остановка: Telegram повторит доставку позже
+            return web.Response(text="Shutting down", status=503)
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        update = await request.json(loads=bot.session.json_loads)
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._process(bot, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._on_update_done)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _process(self, bot: Bot, update: Dict[str, Any]):
+        try:
+            result = await self.dispatcher.feed_raw_update(bot, update, **self.data)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot=bot, result=result)
+        except Exception as e:
+            logger.error(f"Failed to process update {update.get('update_id')}: {e}")
+
+    def _on_update_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        self._semaphore.release()
+
+
+class ShardingRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука супервизора: апдейт не обрабатывается, а передается воркеру.
+    Передача мгновенная, поэтому ни семафора, ни счетчика апдейтов в обработке здесь нет
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, pool: "WorkerPool", **kwargs: Any):
+        super().__init__(dispatcher=dispatcher, bot=bot, **kwargs)
+        self.pool = pool
+        self.accepting = True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.accepting:
+            return web.Response(text="Shutting down", status=503)
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        self.pool.route(await request.json(loads=bot.session.json_loads))
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+
+def build_app(bot: Bot, dp: Dispatcher, secret_token: Optional[str] = None,
+              pool: Optional["WorkerPool"] = None) -> web.Application:
+    """Собирает aiohttp-приложение: вебхук + /health"""
+    app = web.Application()
+    if pool is not None:
+        handler = ShardingRequestHandler(dp, bot, pool, secret_token=secret_token)
+    else:
+        handler = BoundedRequestHandler(
+            dp, bot,
+            max_concurrency=WEBHOOK_MAX_CONCURRENCY,
+            secret_token=secret_token,
+        )
+    handler.register(app, path=WEBHOOK_PATH)
+    app["webhook_handler"] = handler
+
+    async def health(request: web.Request) -> web.Response:
+        data: Dict[str, Any] = {"status": "ok", "mode": "webhook"}
+        if pool is not None:
+            data["workers"] = pool.workers
+            data["workers_alive"] = pool.alive_count()
+        else:
+            data["in_flight"] = handler.in_flight
+        return web.json_response(data)
+
+    app.router.add_get("/health", health)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def _resolve_secret() -> Optional[str]:
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    if WEBHOOK_BASE_URL:
+        # Детерминированный секрет: при деплое старая и новая реплики принимают один и тот же вебхук
+        return hmac.new(BOT_TOKEN.encode(), b"sary-bala-webhook", hashlib.sha256).hexdigest()
+    return None
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, pool: Optional["WorkerPool"] = None):
+    """Поднимает aiohttp-сервер и (если задан публичный адрес) регистрирует вебхук"""
+    secret_token = _resolve_secret()
+    app = build_app(bot, dp, secret_token, pool=pool)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT)
+    await site.start()
+    logger.info(f"Webhook server listening on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_BASE_URL:
+        url = WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH
+        await bot.set_webhook(
+            url,
+            secret_token=secret_token,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100),
+            drop_pending_updates=WEBHOOK_DROP_PENDING_UPDATES,
+        )
+        logger.info(f"Webhook registered: {url}")
+    else:
+        logger.warning("WEBHOOK_LOCAL_ONLY: webhook is not registered in Telegram, "
+                       "updates can only be POSTed locally")
+
+    stop_event = asyncio.Event()
+    install_stop_handlers(stop_event.set)
+
+    try:
+        await stop_event.wait()
+        # Перестаем принимать апдейты, но держим сессию бота открытой, пока генерации дописывают ответы
+        app["webhook_handler"].accepting = False
+        if pool is None:
+            await drain_inflight(SHUTDOWN_GRACE_PERIOD)
+    finally:
+        await runner.cleanup()